@@ -0,0 +1,472 @@
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Dict, Hashable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from urllib.parse import quote
+
+import requests
+import streamlit as st
+from requests.adapters import HTTPAdapter
+
+from airtable_snapshot import SnapshotStore
+
+logger = logging.getLogger(__name__)
+
+# Point this at a local stand-in (see airtable_standin.py) to run without production Airtable
+AIRTABLE_API_URL = os.environ.get("AIRTABLE_API_URL", "https://api.airtable.com/v0").rstrip("/")
+
+# Which Streamlit secret holds the token for each base
+BASE_TOKEN_SECRETS = {
+    "appbJ9Bt0YNuBafT4": "AIRTABLE_PERSONAL_TOKEN",
+    "appkUZW01q89QDGB9": "AIRTABLE_SECOND_TOKEN",
+}
+
+# Airtable allows 5 requests per second per base; a 429 means waiting 30 seconds
+REQUESTS_PER_SECOND = 5
+REQUEST_TIMEOUT = 30
+MAX_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# How long (in seconds) a table's records stay fresh in the shared cache.
+# Tables people edit while the app is open get a short TTL, reference tables a long one.
+DEFAULT_CACHE_TTL = 300
+CACHE_TTLS = {
+    "Content Types": 600,
+    "Client AI + Automation": 600,
+    "Tone": 3600,
+    "Content Kits": 3600,
+    "content": 900,
+}
+
+# Upper limit on the number of (base, table, params) entries held in memory
+CACHE_MAX_ENTRIES = 128
+
+# Local SQLite snapshot of the bases. A warm start only pulls rows changed since the last sync;
+# a full sync (which also catches deleted rows) runs at most every FULL_SYNC_INTERVAL seconds.
+SNAPSHOT_ENABLED = True
+FULL_SYNC_INTERVAL = 24 * 3600
+# Re-read a little before the last sync time so edits made during a sync aren't missed
+DELTA_SYNC_OVERLAP = 60
+# How long a read waits on Airtable before serving the snapshot instead
+SNAPSHOT_SYNC_WAIT = 5
+# How long a snapshot served in place of a failed or slow sync stays in the shared cache
+STALE_CACHE_TTL = 30
+
+# Sentinel the page prefetch thread sends once the last page has been queued
+_END_OF_TABLE = object()
+
+
+# Tokens come from Streamlit secrets; an environment variable of the same name wins,
+# so scripts outside `streamlit run` (like airtable_standin.py) can supply their own
+def airtable_token(token_secret: str) -> str:
+    return os.environ.get(token_secret) or st.secrets[token_secret]
+
+
+class AirtableError(Exception):
+    """Raised when Airtable answers a request with a non-200 status."""
+
+    def __init__(self, table_name: str, status_code: int, text: str):
+        super().__init__(f"Failed to retrieve data from table {table_name}: {status_code} {text}")
+        self.table_name = table_name
+        self.status_code = status_code
+        self.text = text
+
+
+class TokenBucket:
+    """Token-bucket rate limiter: `rate` requests per second, bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Block until a token is available; returns how long we waited
+    def acquire(self) -> float:
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AirtableClient:
+    """
+    One pooled, rate-limited HTTP client for every Airtable call in the app.
+
+    Requests share a keep-alive connection pool, wait on a per-base token bucket,
+    and 429/5xx responses are retried with exponential backoff honouring Retry-After.
+    """
+
+    def __init__(self, requests_per_second: float = REQUESTS_PER_SECOND, timeout: float = REQUEST_TIMEOUT,
+                 max_retries: int = MAX_RETRIES):
+        self.requests_per_second = requests_per_second
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._stats = {"requests": 0, "retries": 0, "throttled": 0, "throttle_wait": 0.0}
+        self._lock = threading.Lock()
+
+    def _bucket(self, base_id: str) -> TokenBucket:
+        with self._lock:
+            if base_id not in self._buckets:
+                self._buckets[base_id] = TokenBucket(self.requests_per_second)
+            return self._buckets[base_id]
+
+    def _count(self, name: str, amount: float = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _backoff(self, attempt: int, response: Optional[requests.Response]) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def get(self, base_id: str, url: str, params: Optional[Dict[str, Any]] = None,
+            token_secret: str = "AIRTABLE_PERSONAL_TOKEN", name: str = "") -> Dict[str, Any]:
+        """GET an Airtable API url and return the decoded JSON, raising AirtableError on failure."""
+        headers = {
+            "Authorization": f"Bearer {airtable_token(token_secret)}"
+        }
+        bucket = self._bucket(base_id)
+        attempt = 0
+        while True:
+            self._count("throttle_wait", bucket.acquire())
+            self._count("requests")
+            response = None
+            try:
+                response = self.session.get(url, headers=headers, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if response.status_code == 200:
+                    return response.json()
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    raise AirtableError(name or url, response.status_code, response.text)
+
+            delay = self._backoff(attempt, response)
+            if response is not None and response.status_code == 429:
+                self._count("throttled")
+                self._count("throttle_wait", delay)
+            self._count("retries")
+            logger.info("Retrying Airtable request for %s in %.1fs (attempt %d)", name or url, delay, attempt + 1)
+            time.sleep(delay)
+            attempt += 1
+
+    # Counters for requests sent, retries, 429s received and seconds spent waiting on rate limits
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._stats)
+
+
+class ShortLived(NamedTuple):
+    """What a TTLCache loader returns for a value to cache for less than the usual TTL, like a stale fallback."""
+    value: Any
+    ttl: float
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after a per-entry TTL.
+
+    Concurrent misses on the same key are collapsed into a single load, so twenty
+    sessions asking for the same table at once cost one Airtable fetch.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._loading: Dict[Hashable, threading.Event] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: Hashable, ttl: float, loader: Callable[[], Any]) -> Any:
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                pending = self._loading.get(key)
+                if pending is None:
+                    pending = self._loading[key] = threading.Event()
+                    generation = self._generation
+                    break
+            # Someone else is already loading this key: wait, then re-check the cache
+            pending.wait()
+
+        try:
+            value = loader()
+            if isinstance(value, ShortLived):
+                value, ttl = value.value, min(ttl, value.ttl)
+            with self._lock:
+                # Don't store a value that was fetched before an invalidation
+                if generation == self._generation:
+                    self._entries[key] = (time.monotonic() + ttl, value)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            return value
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+            pending.set()
+
+    def invalidate(self, predicate: Optional[Callable[[Hashable], bool]] = None) -> int:
+        with self._lock:
+            self._generation += 1
+            if predicate is None:
+                removed = len(self._entries)
+                self._entries.clear()
+                return removed
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale:
+                del self._entries[key]
+            return len(stale)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# One client, cache and snapshot per process, shared by every Streamlit session
+_client = AirtableClient()
+_cache = TTLCache()
+_snapshot = SnapshotStore()
+_sync_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="airtable-sync")
+# The sync running for each (base, table, params), so reads while it's slow wait on it, not on another
+_syncs: Dict[Tuple[str, str, str], Future] = {}
+_syncs_lock = threading.Lock()
+
+
+def _freeze_params(params: Optional[Dict[str, Any]]) -> Tuple:
+    if not params:
+        return ()
+    return tuple(sorted((k, tuple(v) if isinstance(v, list) else v) for k, v in params.items()))
+
+
+def table_url(base_id: str, table_name: str) -> str:
+    return f"{AIRTABLE_API_URL}/{base_id}/{quote(table_name, safe='')}"
+
+
+def get_airtable_client() -> AirtableClient:
+    return _client
+
+
+def iter_record_pages(base_id: str, table_name: str, params: Optional[Dict[str, Any]] = None,
+                      token_secret: str = "AIRTABLE_PERSONAL_TOKEN", prefetch_pages: int = 1) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Yield an Airtable table page by page, following the `offset` cursor.
+
+    With prefetch_pages > 0 a background thread fetches up to that many pages ahead
+    while the caller handles the current one. prefetch_pages=0 is the bounded memory
+    mode: no read-ahead, so only the page being handled is held in memory.
+    """
+    url = table_url(base_id, table_name)
+    params = dict(params or {})
+
+    if prefetch_pages <= 0:
+        while True:
+            data = _client.get(base_id, url, params, token_secret, table_name)
+            yield data.get('records', [])
+            if 'offset' not in data:
+                return
+            params['offset'] = data['offset']
+
+    pages: "queue.Queue" = queue.Queue(maxsize=prefetch_pages)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # Give up if the consumer stopped iterating, instead of blocking forever
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            while not stop.is_set():
+                data = _client.get(base_id, url, params, token_secret, table_name)
+                if not put(data.get('records', [])):
+                    return
+                if 'offset' not in data:
+                    break
+                params['offset'] = data['offset']
+            put(_END_OF_TABLE)
+        except Exception as e:
+            put(e)
+
+    worker = threading.Thread(target=produce, name=f"airtable-pages-{table_name}", daemon=True)
+    worker.start()
+    try:
+        while True:
+            item = pages.get()
+            if item is _END_OF_TABLE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+# Stream records one at a time, on top of iter_record_pages
+def iter_records(base_id: str, table_name: str, params: Optional[Dict[str, Any]] = None,
+                 token_secret: str = "AIRTABLE_PERSONAL_TOKEN", prefetch_pages: int = 1) -> Iterator[Dict[str, Any]]:
+    for page in iter_record_pages(base_id, table_name, params, token_secret, prefetch_pages):
+        yield from page
+
+
+# Quote a value as an Airtable formula string literal, or return None if it can't be done safely
+def formula_string(value: Any) -> Optional[str]:
+    if not isinstance(value, str) or any(ch in value for ch in "\n\r\t"):
+        return None
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def and_formula(*formulas: Optional[str]) -> Optional[str]:
+    formulas = [f for f in formulas if f]
+    if not formulas:
+        return None
+    return formulas[0] if len(formulas) == 1 else f"AND({', '.join(formulas)})"
+
+
+def or_formula(*formulas: Optional[str]) -> Optional[str]:
+    formulas = [f for f in formulas if f]
+    if not formulas:
+        return None
+    return formulas[0] if len(formulas) == 1 else f"OR({', '.join(formulas)})"
+
+
+def _sync_snapshot(base_id: str, table_name: str, params: Dict[str, Any], token_secret: str) -> List[Dict[str, Any]]:
+    params_key = json.dumps(params, sort_keys=True)
+    state = _snapshot.sync_state(base_id, table_name, params_key)
+    started = time.time()
+
+    if state is None or started - state.full_synced_at > FULL_SYNC_INTERVAL:
+        records = list(iter_records(base_id, table_name, params, token_secret))
+        _snapshot.replace(base_id, table_name, params_key, records, synced_at=started)
+        return records
+
+    since = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(state.synced_at - DELTA_SYNC_OVERLAP))
+    delta_params = dict(params)
+    delta_params['filterByFormula'] = and_formula(params.get('filterByFormula'), f"IS_AFTER(LAST_MODIFIED_TIME(), '{since}')")
+    changed = list(iter_records(base_id, table_name, delta_params, token_secret))
+    _snapshot.upsert(base_id, table_name, params_key, changed, synced_at=started)
+    return _snapshot.read(base_id, table_name, params_key)
+
+
+# Start a background sync of the table, or join the one already running for the same params
+def _submit_sync(base_id: str, table_name: str, params: Dict[str, Any], token_secret: str) -> Future:
+    key = (base_id, table_name, json.dumps(params, sort_keys=True))
+    with _syncs_lock:
+        future = _syncs.get(key)
+        started = future is None
+        if started:
+            future = _sync_pool.submit(_sync_snapshot, base_id, table_name, params, token_secret)
+            _syncs[key] = future
+    if started:
+        # Outside the lock: a sync that has already finished runs the callback straight away
+        future.add_done_callback(lambda done: _forget_sync(key, done))
+    return future
+
+
+def _forget_sync(key: Tuple[str, str, str], future: Future):
+    with _syncs_lock:
+        if _syncs.get(key) is future:
+            del _syncs[key]
+
+
+def _load_records(base_id: str, table_name: str, params: Dict[str, Any],
+                  token_secret: str) -> Union[List[Dict[str, Any]], ShortLived]:
+    # Filtered reads are small and vary per request, so they skip the snapshot
+    if not SNAPSHOT_ENABLED or 'filterByFormula' in params:
+        return list(iter_records(base_id, table_name, params, token_secret))
+
+    params_key = json.dumps(params, sort_keys=True)
+    if _snapshot.sync_state(base_id, table_name, params_key) is None:
+        # Cold start: nothing to fall back on, so wait for Airtable
+        return _sync_snapshot(base_id, table_name, params, token_secret)
+
+    future = _submit_sync(base_id, table_name, params, token_secret)
+    try:
+        return future.result(timeout=SNAPSHOT_SYNC_WAIT)
+    except FutureTimeoutError:
+        # Airtable is slow: serve the snapshot, the sync carries on in the background and
+        # drops the stale copy from the cache as soon as it's done
+        logger.warning("Airtable sync of %s is slow, serving the local snapshot", table_name)
+        future.add_done_callback(lambda _: invalidate_airtable_cache(base_id, table_name, expire_snapshot=False))
+    except AirtableError as e:
+        # Only an outage is worth papering over: a 4xx (like the 422 of a renamed field)
+        # has to reach list_records, which knows how to retry it
+        if e.status_code != 429 and e.status_code < 500:
+            raise
+        logger.warning("Airtable sync of %s failed, serving the local snapshot: %s", table_name, e)
+    except requests.RequestException as e:
+        logger.warning("Airtable sync of %s failed, serving the local snapshot: %s", table_name, e)
+    # Cached only briefly, so the next read tries Airtable again soon
+    return ShortLived(_snapshot.read(base_id, table_name, params_key), STALE_CACHE_TTL)
+
+
+# Read every record of an Airtable table through the shared cache and the local snapshot.
+# The returned list is shared between sessions: callers must not mutate it.
+def list_records(base_id: str, table_name: str, params: Optional[Dict[str, Any]] = None,
+                 token_secret: str = "AIRTABLE_PERSONAL_TOKEN", ttl: Optional[float] = None) -> List[Dict[str, Any]]:
+    params = params or {}
+    key = (base_id, table_name, _freeze_params(params))
+    if ttl is None:
+        ttl = CACHE_TTLS.get(table_name, DEFAULT_CACHE_TTL)
+    try:
+        return _cache.get_or_load(key, ttl, lambda: _load_records(base_id, table_name, params, token_secret))
+    except AirtableError as e:
+        # A 422 here usually means a projected or filtered field was renamed. Both are
+        # optimisations, so drop the projection first, keeping the filter that saves most of
+        # the transfer, and only fetch every row if that still gets a 422.
+        optional = next((name for name in ('fields[]', 'filterByFormula') if name in params), None)
+        if e.status_code != 422 or optional is None:
+            raise
+        logger.warning("Airtable rejected %s for %s, fetching without it: %s", optional, table_name, e.text)
+        params = {k: v for k, v in params.items() if k != optional}
+        return list_records(base_id, table_name, params, token_secret, ttl)
+
+
+# The "refresh from Airtable" hook: drop cached records for one table, one base, or everything.
+# The snapshot keeps its rows (so it can still serve reads) but the next sync is a full one,
+# unless expire_snapshot is False.
+def invalidate_airtable_cache(base_id: Optional[str] = None, table_name: Optional[str] = None,
+                              expire_snapshot: bool = True) -> int:
+    if SNAPSHOT_ENABLED and expire_snapshot:
+        _snapshot.expire(base_id, table_name)
+    if base_id is None and table_name is None:
+        return _cache.invalidate()
+    return _cache.invalidate(
+        lambda key: (base_id is None or key[0] == base_id) and (table_name is None or key[1] == table_name)
+    )
@@ -0,0 +1,104 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional
+
+from airtable import AIRTABLE_API_URL, BASE_TOKEN_SECRETS, get_airtable_client
+
+logger = logging.getLogger(__name__)
+
+# Where the table and field metadata of every base is kept between runs
+SCHEMA_PATH = os.environ.get("AIRTABLE_SCHEMA_PATH", ".airtable_schema.json")
+
+
+class SchemaRegistry:
+    """
+    Table and field IDs for every Airtable base, from the metadata API.
+
+    The metadata is fetched once, written to SCHEMA_PATH and loaded from there on
+    later starts, so resolving a name to an ID is a dict lookup, not an API call.
+    """
+
+    def __init__(self, path: str = SCHEMA_PATH, bases: Optional[Dict[str, str]] = None):
+        self.path = path
+        self.bases = bases or BASE_TOKEN_SECRETS
+        # base_id -> table name -> {"id": table ID, "fields": {field name: field ID}}
+        self._tables: Dict[str, Dict[str, Dict]] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    self._tables = json.load(f)
+            else:
+                self._tables = self._fetch()
+                self._save()
+            self._loaded = True
+
+    def _fetch(self) -> Dict[str, Dict[str, Dict]]:
+        client = get_airtable_client()
+        schema = {}
+        for base_id, token_secret in self.bases.items():
+            url = f"{AIRTABLE_API_URL}/meta/bases/{base_id}/tables"
+            try:
+                tables = client.get(base_id, url, token_secret=token_secret, name="metadata").get('tables', [])
+            except Exception as e:
+                # Tokens without schema.bases:read can't see metadata; those tables fall back to names
+                logger.warning("Could not fetch Airtable metadata for base %s: %s", base_id, e)
+                continue
+            schema[base_id] = {
+                table['name']: {
+                    "id": table['id'],
+                    "fields": {field['name']: field['id'] for field in table.get('fields', [])},
+                }
+                for table in tables
+            }
+        return schema
+
+    def _save(self):
+        if not self._tables:
+            return
+        with open(self.path, "w") as f:
+            json.dump(self._tables, f, indent=2)
+
+    # Re-read the metadata of every base from Airtable and persist it
+    def refresh(self):
+        tables = self._fetch()
+        with self._lock:
+            self._tables = tables
+            self._save()
+            self._loaded = True
+
+    def table_id(self, base_id: str, table_name: str) -> Optional[str]:
+        self._ensure_loaded()
+        table = self._tables.get(base_id, {}).get(table_name)
+        return table["id"] if table else None
+
+    def fields(self, base_id: str, table_name: str) -> Dict[str, str]:
+        self._ensure_loaded()
+        return dict(self._tables.get(base_id, {}).get(table_name, {}).get("fields", {}))
+
+    def field_ids(self, base_id: str, table_name: str, field_names: List[str]) -> Optional[Dict[str, str]]:
+        """
+        Map field names to IDs. Names the table doesn't have are left out;
+        None means the registry doesn't know the table at all.
+        """
+        self._ensure_loaded()
+        table = self._tables.get(base_id, {}).get(table_name)
+        if table is None:
+            return None
+        return {name: table["fields"][name] for name in field_names if name in table["fields"]}
+
+
+_registry = SchemaRegistry()
+
+
+def get_schema_registry() -> SchemaRegistry:
+    return _registry
@@ -0,0 +1,139 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional
+
+# Where the local copy of the Airtable bases lives
+SNAPSHOT_PATH = os.environ.get("AIRTABLE_SNAPSHOT_PATH", ".airtable_snapshot.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    base_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    params_key TEXT NOT NULL,
+    record_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    record_json TEXT NOT NULL,
+    PRIMARY KEY (base_id, table_name, params_key, record_id)
+);
+CREATE TABLE IF NOT EXISTS sync_state (
+    base_id TEXT NOT NULL,
+    table_name TEXT NOT NULL,
+    params_key TEXT NOT NULL,
+    synced_at REAL NOT NULL,
+    full_synced_at REAL NOT NULL,
+    PRIMARY KEY (base_id, table_name, params_key)
+);
+"""
+
+
+class SyncState(NamedTuple):
+    synced_at: float
+    full_synced_at: float
+
+
+class SnapshotStore:
+    """
+    SQLite copy of Airtable tables, one row per record.
+
+    Each (base, table, query params) combination is stored separately, because params
+    like returnFieldsByFieldId change the shape of the records.
+    """
+
+    def __init__(self, path: str = SNAPSHOT_PATH):
+        self.path = path
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.executescript(_SCHEMA)
+                    self._initialized = True
+        return conn
+
+    def sync_state(self, base_id: str, table_name: str, params_key: str) -> Optional[SyncState]:
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT synced_at, full_synced_at FROM sync_state WHERE base_id = ? AND table_name = ? AND params_key = ?",
+                (base_id, table_name, params_key),
+            ).fetchone()
+        finally:
+            conn.close()
+        return SyncState(*row) if row else None
+
+    def read(self, base_id: str, table_name: str, params_key: str) -> List[Dict[str, Any]]:
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT record_json FROM records WHERE base_id = ? AND table_name = ? AND params_key = ? ORDER BY position",
+                (base_id, table_name, params_key),
+            ).fetchall()
+        finally:
+            conn.close()
+        return [json.loads(row[0]) for row in rows]
+
+    # Full sync: the snapshot becomes exactly these records, which also drops deleted ones
+    def replace(self, base_id: str, table_name: str, params_key: str, records: List[Dict[str, Any]], synced_at: float):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "DELETE FROM records WHERE base_id = ? AND table_name = ? AND params_key = ?",
+                    (base_id, table_name, params_key),
+                )
+                conn.executemany(
+                    "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?)",
+                    [(base_id, table_name, params_key, record['id'], position, json.dumps(record))
+                     for position, record in enumerate(records)],
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?, ?)",
+                    (base_id, table_name, params_key, synced_at, synced_at),
+                )
+        finally:
+            conn.close()
+
+    # Delta sync: changed records keep their position, new ones go to the end
+    def upsert(self, base_id: str, table_name: str, params_key: str, records: List[Dict[str, Any]], synced_at: float):
+        conn = self._connect()
+        try:
+            with conn:
+                (next_position,) = conn.execute(
+                    "SELECT COALESCE(MAX(position) + 1, 0) FROM records WHERE base_id = ? AND table_name = ? AND params_key = ?",
+                    (base_id, table_name, params_key),
+                ).fetchone()
+                for record in records:
+                    updated = conn.execute(
+                        "UPDATE records SET record_json = ? WHERE base_id = ? AND table_name = ? AND params_key = ? AND record_id = ?",
+                        (json.dumps(record), base_id, table_name, params_key, record['id']),
+                    ).rowcount
+                    if not updated:
+                        conn.execute(
+                            "INSERT INTO records VALUES (?, ?, ?, ?, ?, ?)",
+                            (base_id, table_name, params_key, record['id'], next_position, json.dumps(record)),
+                        )
+                        next_position += 1
+                conn.execute(
+                    "UPDATE sync_state SET synced_at = ? WHERE base_id = ? AND table_name = ? AND params_key = ?",
+                    (synced_at, base_id, table_name, params_key),
+                )
+        finally:
+            conn.close()
+
+    # Force the next sync of matching tables to be a full one, keeping the rows to serve meanwhile
+    def expire(self, base_id: Optional[str] = None, table_name: Optional[str] = None):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "UPDATE sync_state SET full_synced_at = 0 WHERE (? IS NULL OR base_id = ?) AND (? IS NULL OR table_name = ?)",
+                    (base_id, base_id, table_name, table_name),
+                )
+        finally:
+            conn.close()
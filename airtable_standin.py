@@ -0,0 +1,225 @@
+"""
+Local stand-in for the Airtable REST API, for benchmarking the data layer offline.
+
+Serves recorded fixtures for the record list endpoint (with offset pagination,
+fields[] and returnFieldsByFieldId) and the metadata endpoint, with configurable
+latency and injected 429s. Point the app at it with
+
+    AIRTABLE_API_URL=http://127.0.0.1:8765/v0 streamlit run Home.py
+
+Usage:
+    python airtable_standin.py serve [--latency 0.2] [--throttle-every 10] [--rate-limit 5]
+    python airtable_standin.py record            # needs real tokens in .streamlit/secrets.toml
+    AIRTABLE_API_URL=http://127.0.0.1:8765/v0 AIRTABLE_PERSONAL_TOKEN=x AIRTABLE_SECOND_TOKEN=x \
+        python airtable_standin.py bench         # cold/warm list_records timings against a running stand-in
+
+Fixtures live in FIXTURES_DIR as <base_id>/meta.json (the metadata API response) and
+<base_id>/tables/<table name>.json (every record of the table, fields keyed by name).
+filterByFormula is ignored, so filtered reads get every row back; the app's Python-side
+filters still apply.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs, unquote, urlparse
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "airtable")
+
+
+class StandinConfig:
+    def __init__(self, fixtures_dir: str = FIXTURES_DIR, latency: float = 0.0, page_size: int = 100,
+                 throttle_every: int = 0, rate_limit: float = 0, retry_after: float = 1):
+        self.fixtures_dir = fixtures_dir
+        # Seconds added to every response
+        self.latency = latency
+        # Records per page; Airtable's own maximum is 100
+        self.page_size = page_size
+        # Answer every Nth request with a 429 (0 disables), for deterministic throttling
+        self.throttle_every = throttle_every
+        # Emulate Airtable's per-base requests/second limit (0 disables)
+        self.rate_limit = rate_limit
+        # Retry-After sent with injected 429s; real Airtable asks for 30 seconds
+        self.retry_after = retry_after
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    config: StandinConfig = StandinConfig()
+    _lock = threading.Lock()
+    _request_count = 0
+    _recent = defaultdict(deque)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _throttled(self, base_id: str) -> bool:
+        with self._lock:
+            StandinHandler._request_count += 1
+            if self.config.throttle_every and StandinHandler._request_count % self.config.throttle_every == 0:
+                return True
+            if self.config.rate_limit:
+                now = time.monotonic()
+                recent = self._recent[base_id]
+                while recent and now - recent[0] > 1:
+                    recent.popleft()
+                if len(recent) >= self.config.rate_limit:
+                    return True
+                recent.append(now)
+        return False
+
+    def _load(self, *parts: str) -> Optional[Any]:
+        path = os.path.join(self.config.fixtures_dir, *parts)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        query = parse_qs(url.query)
+
+        if self.config.latency:
+            time.sleep(self.config.latency)
+
+        if len(parts) == 5 and parts[:3] == ["v0", "meta", "bases"] and parts[4] == "tables":
+            base_id = parts[3]
+        elif len(parts) == 3 and parts[0] == "v0":
+            base_id = parts[1]
+        else:
+            return self._send_json(404, {"error": "NOT_FOUND"})
+
+        if self._throttled(base_id):
+            return self._send_json(429, {"errors": [{"error": "RATE_LIMIT_REACHED"}]},
+                                   {"Retry-After": str(self.config.retry_after)})
+
+        if parts[1] == "meta":
+            meta = self._load(base_id, "meta.json")
+            if meta is None:
+                return self._send_json(404, {"error": "NOT_FOUND"})
+            return self._send_json(200, meta)
+
+        table_name = parts[2]
+        records = self._load(base_id, "tables", f"{table_name}.json")
+        if records is None:
+            return self._send_json(404, {"error": {"type": "TABLE_NOT_FOUND"}})
+        # Like Airtable, reject a projection naming a field the table doesn't have (e.g. after a rename)
+        meta = self._load(base_id, "meta.json") or {"tables": []}
+        field_ids = {field["id"] for table in meta["tables"] if table["name"] == table_name for field in table["fields"]}
+        known = field_ids | {name for record in records for name in record["fields"]}
+        unknown = [field for field in query.get("fields[]", []) if field not in known]
+        if unknown:
+            return self._send_json(422, {"error": {"type": "UNKNOWN_FIELD_NAME",
+                                                   "message": f'Unknown field name: "{unknown[0]}"'}})
+        self._send_json(200, self._page(base_id, table_name, records, query))
+
+    def _page(self, base_id: str, table_name: str, records: List[Dict[str, Any]], query: Dict[str, List[str]]) -> Dict[str, Any]:
+        meta = self._load(base_id, "meta.json") or {"tables": []}
+        table = next((t for t in meta["tables"] if t["name"] == table_name), {"fields": []})
+        name_to_id = {field["name"]: field["id"] for field in table["fields"]}
+        id_to_name = {field["id"]: field["name"] for field in table["fields"]}
+
+        wanted = [id_to_name.get(field, field) for field in query.get("fields[]", [])]
+        by_id = query.get("returnFieldsByFieldId", ["false"])[0] == "true"
+        start = int(query.get("offset", ["0"])[0])
+        page_size = min(int(query.get("pageSize", [self.config.page_size])[0]), self.config.page_size)
+
+        page = []
+        for record in records[start:start + page_size]:
+            fields = {name: value for name, value in record["fields"].items() if not wanted or name in wanted}
+            if by_id:
+                fields = {name_to_id.get(name, name): value for name, value in fields.items()}
+            page.append({**record, "fields": fields})
+
+        body = {"records": page}
+        if start + page_size < len(records):
+            body["offset"] = str(start + page_size)
+        return body
+
+
+def serve(config: StandinConfig, host: str = "127.0.0.1", port: int = 8765) -> ThreadingHTTPServer:
+    """Start the stand-in on a background thread and return the server (call shutdown() to stop)."""
+    StandinHandler.config = config
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    threading.Thread(target=server.serve_forever, name="airtable-standin", daemon=True).start()
+    return server
+
+
+# Record fixtures from production Airtable: metadata plus every record of every table
+def record(fixtures_dir: str = FIXTURES_DIR):
+    from airtable import AIRTABLE_API_URL, BASE_TOKEN_SECRETS, get_airtable_client, iter_records
+
+    client = get_airtable_client()
+    for base_id, token_secret in BASE_TOKEN_SECRETS.items():
+        meta = client.get(base_id, f"{AIRTABLE_API_URL}/meta/bases/{base_id}/tables", token_secret=token_secret, name="metadata")
+        os.makedirs(os.path.join(fixtures_dir, base_id, "tables"), exist_ok=True)
+        with open(os.path.join(fixtures_dir, base_id, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+        for table in meta["tables"]:
+            records = list(iter_records(base_id, table["name"], token_secret=token_secret))
+            with open(os.path.join(fixtures_dir, base_id, "tables", f"{table['name']}.json"), "w") as f:
+                json.dump(records, f, indent=2)
+            print(f"Recorded {len(records)} records from {base_id}/{table['name']}")
+
+
+# Time cold and warm reads of every fixture table through list_records
+def bench(fixtures_dir: str = FIXTURES_DIR):
+    import airtable
+
+    # Measure the HTTP, pagination and cache paths, not a snapshot left over from an earlier run
+    airtable.SNAPSHOT_ENABLED = False
+    for base_id, token_secret in airtable.BASE_TOKEN_SECRETS.items():
+        tables_dir = os.path.join(fixtures_dir, base_id, "tables")
+        if not os.path.isdir(tables_dir):
+            continue
+        for filename in sorted(os.listdir(tables_dir)):
+            table_name = filename[:-len(".json")]
+            timings = []
+            for _ in range(2):
+                started = time.perf_counter()
+                records = airtable.list_records(base_id, table_name, token_secret=token_secret)
+                timings.append(time.perf_counter() - started)
+            print(f"{base_id}/{table_name}: {len(records)} records, cold {timings[0]:.3f}s, warm {timings[1]:.4f}s")
+    print(json.dumps(airtable.get_airtable_client().stats(), indent=2))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Airtable API")
+    parser.add_argument("command", choices=["serve", "record", "bench"])
+    parser.add_argument("--fixtures", default=FIXTURES_DIR)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--throttle-every", type=int, default=0)
+    parser.add_argument("--rate-limit", type=float, default=0)
+    parser.add_argument("--retry-after", type=float, default=1)
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.fixtures)
+    elif args.command == "bench":
+        bench(args.fixtures)
+    else:
+        server = serve(StandinConfig(args.fixtures, args.latency, args.page_size, args.throttle_every,
+                                     args.rate_limit, args.retry_after), args.host, args.port)
+        print(f"Airtable stand-in on http://{args.host}:{args.port}/v0 (fixtures: {args.fixtures})")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -2,16 +2,25 @@ import streamlit as st
 import requests
 import re
 import json
+import logging
 import pandas as pd
 import openai
 from typing import List, Dict, Union, Any, Tuple
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from PIL import Image
+from airtable import list_records, AirtableError, and_formula, or_formula, formula_string
+from airtable_schema import get_schema_registry
+from llm import chat_completion, chat_completion_stream, model_for
+from llm_telemetry import bind_context
+
+logger = logging.getLogger(__name__)
 
 # Define the OpenAI model
-model = "gpt-4-turbo"
-parsing_model = "gpt-4o"
+model = model_for("generate")
+parsing_model = model_for("parse")
+structured_model = model_for("structured")
 
 # Define types for readability
 ParsedArgument = Dict[str, str]
@@ -49,40 +58,95 @@ Hashtag 2: #MoneyMoves
 
 As you can see, we return the response with keys separated from values by a colon. The keys are grouped together. No values are shared.
 
-Now that we've finished the example, let's move on to the actual request. Here's the actual layout I'd like you to use:"""
+Now that we've finished the example, let's move on to the actual request."""
+
+# Field manifest: the fields each Airtable fetcher actually reads. They are sent as fields[]
+# so unused columns (like the big synced Content field) never cross the network.
+# Tables not listed here, such as the layout tables, are fetched with every field.
+# A tuple lists alternative names for one field, most preferred first: only the ones the
+# table actually has are requested.
+FIELD_MANIFEST = {
+    "Content Types": [
+        "Content Type",
+        "Type",
+        "Image Prompt",
+        "Example Prompt",
+        "Content Professional",
+        "Content Casual",
+        "Content Direct",
+        "v1",
+        "DesignHuddle Link",
+    ],
+    "Client AI + Automation": ["Customer Name", "AI Brand Tone Prompt"],
+    "Tone": ["Tone", "Tone Description"],
+    "Content Kits": ["Content Kit"],
+    "content": [
+        "Content Kits",
+        "Step",
+        "Step Description",
+        ("Content Type (from Content Type)", "Content Type"),
+        "Type",
+        "Content Title",
+        "Description",
+    ],
+}
+
+# Fetch a manifest table by field ID and hand the records back with fields keyed by name.
+# The IDs come from the schema registry, so renaming a field in Airtable doesn't break the
+# fetch. If the registry doesn't know the table, or is missing any of its manifest fields,
+# fall back to requesting fields by name.
+def fetch_manifest_records(base_id, table_name, token_secret="AIRTABLE_PERSONAL_TOKEN", params=None):
+    entries = [entry if isinstance(entry, tuple) else (entry,) for entry in FIELD_MANIFEST[table_name]]
+    known = get_schema_registry().field_ids(base_id, table_name, [name for names in entries for name in names])
+    if known is None:
+        # Without the schema there's no telling which alternative the table has, so ask for all of them
+        params = {**(params or {}), "fields[]": [name for names in entries for name in names]}
+        return list_records(base_id, table_name, params=params, token_secret=token_secret)
+
+    # The first alternative of each entry that the table has
+    field_ids, missing = {}, []
+    for names in entries:
+        name = next((name for name in names if name in known), None)
+        if name is None:
+            missing.append(names[0])
+        else:
+            field_ids[name] = known[name]
+    if missing:
+        logger.warning("Schema registry has no %s field(s) %s, requesting fields by name", table_name, ", ".join(missing))
+        params = {**(params or {}), "fields[]": list(field_ids) + missing}
+        return list_records(base_id, table_name, params=params, token_secret=token_secret)
+
+    params = {**(params or {}), "returnFieldsByFieldId": "true", "fields[]": list(field_ids.values())}
+    records = list_records(base_id, table_name, params=params, token_secret=token_secret)
+    return [
+        {**record, "fields": {name: record['fields'][field_id] for name, field_id in field_ids.items() if field_id in record['fields']}}
+        for record in records
+    ]
 
-# Function to get data from the "Content Types" table using field IDs
+# Function to get data from the "Content Types" table
 def get_content_types_data():
     base_id = 'appbJ9Bt0YNuBafT4'
     table_name = "Content Types"
-    airtable_token = st.secrets.AIRTABLE_PERSONAL_TOKEN
-    headers = {
-        "Authorization": f"Bearer {airtable_token}"
-    }
 
-    url = f"https://api.airtable.com/v0/{base_id}/{table_name}?returnFieldsByFieldId=true"
-    response = requests.get(url, headers=headers)
-
-    if response.status_code != 200:
-        st.error(f"Failed to retrieve data from table {table_name}: {response.text}")
+    try:
+        records = fetch_manifest_records(base_id, table_name)
+    except AirtableError as e:
+        st.error(f"Failed to retrieve data from table {table_name}: {e.text}")
         return []
-
-    records = response.json().get('records', [])
     
     data = []
 
     for record in records:
         fields = record.get('fields', {})
-        content_type = fields.get('fldaCnCA1wmlTY1HR', 'N/A')  # Content Type
-        type_ = fields.get('fldJg8ITzVFzf8sJx', None)  # Type
-        image_prompt = fields.get('fldn0VPsaEnostire', None)  # Image Prompt
-        example_prompt = fields.get('fldwAUyVUHPY0pJRV', None)  # Example Prompt
-        content_professional = fields.get('fldSC1pBRPq0YhVgd', None)  # Content Professional
-        content_casual = fields.get('fld4YQ7TBqU4rgU2L', None)  # Content Casual
-        content_direct = fields.get('fldyhq9gi63C3qrTG', None)  # Content Direct
-        v1 = fields.get('fld562mr7ro6jODUz', False)  # v1
-        designhuddle_link = fields.get('fldhbUkT1QboXcsbG', 'N/A')  # DesignHuddle Link
-        content = fields.get('fldbiEIqHlbrdCOhf', 'N/A')  # Content (synced table)
+        content_type = fields.get('Content Type', 'N/A')
+        type_ = fields.get('Type', None)
+        image_prompt = fields.get('Image Prompt', None)
+        example_prompt = fields.get('Example Prompt', None)
+        content_professional = fields.get('Content Professional', None)
+        content_casual = fields.get('Content Casual', None)
+        content_direct = fields.get('Content Direct', None)
+        v1 = fields.get('v1', False)
+        designhuddle_link = fields.get('DesignHuddle Link', 'N/A')
         data.append({
             "Content Type": content_type,
             "Type": type_,
@@ -92,8 +156,7 @@ def get_content_types_data():
             "Content Casual": content_casual,
             "Content Direct": content_direct,
             "v1": v1,
-            "DesignHuddle Link": designhuddle_link,
-            "Content": content
+            "DesignHuddle Link": designhuddle_link
         })
 
     return data
@@ -103,38 +166,28 @@ def get_client_data():
     """
     Fetch client names and their associated tone prompts from Airtable.
     """
-    url = "https://api.airtable.com/v0/appbJ9Bt0YNuBafT4/Client%20AI%20+%20Automation"
-    airtable_token = st.secrets.AIRTABLE_PERSONAL_TOKEN
-    headers = {
-        "Authorization": f"Bearer {airtable_token}"
-    }
-    response = requests.get(url, headers=headers)
-
-    if response.status_code == 200:
-        records = response.json()['records']
-        client_data = {}
-        for record in records:
-            fields = record['fields']
-            if 'Customer Name' in fields and 'AI Brand Tone Prompt' in fields:
-                client_data[fields['Customer Name']] = fields['AI Brand Tone Prompt']
-        return client_data
-    else:
+    try:
+        records = fetch_manifest_records('appbJ9Bt0YNuBafT4', "Client AI + Automation")
+    except AirtableError:
         return {}
 
+    client_data = {}
+    for record in records:
+        fields = record['fields']
+        if 'Customer Name' in fields and 'AI Brand Tone Prompt' in fields:
+            client_data[fields['Customer Name']] = fields['AI Brand Tone Prompt']
+    return client_data
+
 # Function to get all the Layout table data from Airtable when the user selects a table
 def get_table_data(table_name):
     """
     Fetch table data from Airtable based on the given table name.
     """
-    url = f"https://api.airtable.com/v0/appbJ9Bt0YNuBafT4/{table_name}"
-    airtable_token = st.secrets.AIRTABLE_PERSONAL_TOKEN
-    headers = {
-        "Authorization": f"Bearer {airtable_token}"
-    }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()['records']
-    else:
+    try:
+        if table_name in FIELD_MANIFEST:
+            return fetch_manifest_records('appbJ9Bt0YNuBafT4', table_name)
+        return list_records('appbJ9Bt0YNuBafT4', table_name)
+    except AirtableError:
         return []
 
 # Function to make the little image selection table on the page
@@ -159,7 +212,8 @@ def process_table_data(table_data):
     # Prepare a list of dictionaries with flattened 'fields' and additional metadata
     processed_data = []
     for record in table_data:
-        fields = record.get('fields', {})
+        # Copy the fields: records come from the shared Airtable cache
+        fields = dict(record.get('fields', {}))
         fields['id'] = record.get('id', '')
         fields['createdTime'] = record.get('createdTime', '')
         processed_data.append(fields)
@@ -286,6 +340,21 @@ def generate_prompts_array(topic, image_prompt, layouts_array):
     
     return prompts_array
 
+# Messages for one layout's generation, ordered from most to least shared so OpenAI's prompt
+# cache can reuse the longest possible prefix: the fewshot instructions (identical for every
+# call) as the system message, then the content type's image prompt (shared by every layout of
+# the run), then the layout, and only then the topic and variation count.
+def build_generation_messages(image_prompt, layout_text, topic, variations):
+    return [
+        {"role": "system", "content": fewshot_prompt},
+        {"role": "user", "content": f"{image_prompt}\n\n---------\n\nHere's the actual layout I'd like you to use:\n\n{layout_text}\n\n---------\n\nHere's the topic:\n\n{topic}\n\nPlease make {variations} full variations. Each one should have all the keys you see in the layout description above."},
+    ]
+
+# Messages for a content subloop prompt, ordered like build_generation_messages: the company's
+# tone (shared by every content prompt) first, then the content prompt, then the topic
+def build_content_messages(company_tone_style, prompt_content, topic, variations):
+    return [{"role": "user", "content": company_tone_style + "\n\n--------------\n\n" + prompt_content + "\n\n-----------\n\n" + topic + "\n\nPlease create " + str(variations) + " different variations."}]
+
 # Creates the array of prompts to send to OpenAI
 def generate_prompts_array_with_variations(topic, image_prompt, layouts_array, variations):
     prompts_array = []
@@ -295,45 +364,100 @@ def generate_prompts_array_with_variations(topic, image_prompt, layouts_array, v
             prompt_messages = []
             layout_messages = []
 
-            # Combine image_prompt, layout 'Text' and 'Specs'
-            full_prompt = f"{image_prompt}\n\n{fewshot_prompt}\n\n---------\n\n{layout_details['Text']}\n\n---------\n\nHere's the topic:\n\n{topic}\n\nPlease make {variations} full variations. Each one should have all the keys you see in the layout description above."
-            prompt_messages.append({"role": "user", "content": full_prompt})
+            # Combine fewshot_prompt, image_prompt, layout 'Text' and the topic, most static first
+            prompt_messages.extend(build_generation_messages(image_prompt, layout_details['Text'], topic, variations))
 
             layout_messages.append({"role": "user", "content": layout_details['Text']})
 
             specs = layout_details.get('Specs', {})
 
-            prompts_array.append({"message": prompt_messages, "layout": layout_messages, "specs": specs})
+            # For schema-constrained generation
+            schema = layout_schema(layout_details['Text'], specs)
+
+            prompts_array.append({"message": prompt_messages, "layout": layout_messages, "specs": specs, "schema": schema})
 
     return prompts_array
 
+# Instructions for schema-constrained generation, in place of fewshot_prompt: the schema pins the format
+structured_prompt = """Write the text for the layout below. Return every variation asked for, each with a value for every key of the layout. Each value has to meet the limits in its key's description: put each line of a value on its own line, separated by \n, and don't repeat the key in the value."""
+
+# Compile a layout's keys and specs into a JSON schema for structured output: an array of
+# variations, each with one string per key. Strict mode doesn't enforce string lengths, so
+# each key's limits go into its description.
+def layout_schema(layout_text, specs):
+    properties = {}
+    for key, description in layout_fields(layout_text):
+        spec = find_spec(key, specs)
+        properties[key] = {"type": "string", "description": f"{description} ({describe_spec(spec)})" if spec else description}
+    variation = {"type": "object", "properties": properties, "required": list(properties), "additionalProperties": False}
+    return {
+        "type": "object",
+        "properties": {"variations": {"type": "array", "items": variation}},
+        "required": ["variations"],
+        "additionalProperties": False,
+    }
+
+# The request send_to_openai makes, for callers that send it another way (the Batch API).
+# With a schema it's schema-constrained: the structured model, structured_prompt in place of
+# fewshot_prompt, and the response held to the schema.
+def generation_request(messages, schema=None):
+    if schema is None:
+        return {"model": model, "messages": messages}
+    messages = [{"role": "system", "content": structured_prompt}] + [m for m in messages if m["content"] != fewshot_prompt]
+    return {
+        "model": structured_model,
+        "messages": messages,
+        "response_format": {"type": "json_schema", "json_schema": {"name": "layout_variations", "strict": True, "schema": schema}},
+    }
+
 # Function to send request to OpenAI API
-def send_to_openai(messages):
+def send_to_openai(messages, use_cache=True, stage="generate", schema=None):
     try:
-        response = openai.chat.completions.create(
-            model=model,
-            messages=messages
-        )
+        response = chat_completion(use_cache=use_cache, stage=stage, **generation_request(messages, schema))
         return response.choices[0].message.content
     except Exception as e:
-        print(f"An error occurred: {e}")
+        print(f"An error occurred: {type(e).__name__}: {e}")
         return None
 
+# Appended to a streamed response that broke part way, so the partial text isn't taken for the whole
+STREAM_INTERRUPTED_MARKER = "\n\n[response interrupted]"
+
+# Streaming version of send_to_openai: yields the response text as it arrives, for pages to
+# render progressively. On an error before any text it stops, like send_to_openai returning
+# None; after some text it ends with STREAM_INTERRUPTED_MARKER.
+def stream_to_openai(messages, use_cache=True, stage="generate"):
+    streamed = False
+    try:
+        for delta in chat_completion_stream(
+            use_cache=use_cache,
+            stage=stage,
+            model=model,
+            messages=messages
+        ):
+            streamed = True
+            yield delta
+    except Exception as e:
+        print(f"An error occurred: {type(e).__name__}: {e}")
+        if streamed:
+            yield STREAM_INTERRUPTED_MARKER
+
 # Function to send request to OpenAI API
-def send_plaintext_to_openai(plaintext):
+def send_plaintext_to_openai(plaintext, use_cache=True, stage="fix"):
     messages = []
     messages.append({"role": "user", "content": plaintext})
     try:
-        response = openai.chat.completions.create(
+        response = chat_completion(
+            use_cache=use_cache,
+            stage=stage,
             model=model,
             messages=messages
         )
         return response.choices[0].message.content
     except Exception as e:
-        print(f"An error occurred: {e}")
+        print(f"An error occurred: {type(e).__name__}: {e}")
         return None
 
-# Tools object that breaks down a response into parts
+# Tools object that breaks down a response into parts, one fit_to_spec call per part (the parse uses extract_tools)
 tools = [
     {
         "type": "function",
@@ -358,6 +482,42 @@ tools = [
     }
 ]
 
+# Tool that returns every key/value pair of a response in one call: one array instead of a
+# fit_to_spec call (and its envelope) per pair
+extract_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "extract_pairs",
+            "description": "Splits a message into its components, in the order they appear.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "pairs": {
+                        "type": "array",
+                        "description": "Every component of the message. A key that appears several times, once per variation, gets a pair each time.",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "key": {
+                                    "type": "string",
+                                    "description": "The name of the component, like TITLE or SUBTITLE. Match exactly with what you see, eg return HASHTAG 2 instead of HASHTAG if you see HASHTAG 2",
+                                },
+                                "value": {
+                                    "type": "string",
+                                    "description": "The value of the component. Make sure to preserve newlines as \n",
+                                },
+                            },
+                            "required": ["key", "value"],
+                        },
+                    },
+                },
+                "required": ["pairs"],
+            },
+        }
+    }
+]
+
 def evaluate_character_count_and_lines(pairs_json, specs):
     evaluation_result = []
 
@@ -463,8 +623,15 @@ def extract_key_value_pairs(response: Any) -> List[Dict[str, str]]:
             if arguments is None:
                 continue
 
-            # Check if arguments contains 'tool_uses' or is directly map of key-value pairs
-            if isinstance(arguments, dict) and 'tool_uses' in arguments:
+            # One extract_pairs call with every pair, several tool_uses, or a single fit_to_spec pair
+            if isinstance(arguments, dict) and isinstance(arguments.get('pairs'), list):
+                for pair in arguments['pairs']:
+                    if isinstance(pair, dict) and 'key' in pair and 'value' in pair:
+                        key_value_pairs.append({
+                            'key': pair['key'],
+                            'value': pair['value']
+                        })
+            elif isinstance(arguments, dict) and 'tool_uses' in arguments:
                 tool_uses = arguments['tool_uses']
                 for tool_use in tool_uses:
                     if 'parameters' in tool_use:
@@ -485,17 +652,107 @@ def extract_key_value_pairs(response: Any) -> List[Dict[str, str]]:
     return key_value_pairs
 
 # Function to send request to OpenAI API
-def send_to_openai_with_tools(messages):
+def send_to_openai_with_tools(messages, use_cache=True, stage="parse"):
     try:
-        response = openai.chat.completions.create(
+        response = chat_completion(
+            use_cache=use_cache,
+            stage=stage,
             model=parsing_model,
             messages=messages,
-            tools=tools
+            tools=extract_tools,
+            tool_choice={"type": "function", "function": {"name": "extract_pairs"}}
         )
         return response
     except Exception as e:
-        print(f"An error occurred: {e}")
+        print(f"An error occurred: {type(e).__name__}: {e}")
+        return None
+
+# The keys a layout asks for and their descriptions, in order: the "Key: description" lines of its Text
+def layout_fields(layout_text):
+    fields = []
+    for line in layout_text.splitlines():
+        key, colon, description = line.partition(":")
+        if colon and key.strip() and not line.startswith("**"):
+            fields.append((key.strip(), description.strip()))
+    return fields
+
+def layout_keys(layout_text):
+    return [key for key, _ in layout_fields(layout_text)]
+
+# Split a generation in the fewshot format into key/value pairs without an LLM call. A line
+# starting with one of the layout's keys and a colon starts a value, and the lines after it
+# continue it until the next key or a blank line. Text before the first key or after the
+# last value (a preamble or a sign-off) is ignored.
+# Returns the pairs and a confidence between 0 and 1: the share of the layout's keys found,
+# times the share of lines that belonged to a value, times how evenly the keys' variation
+# counts came out. Anything short of the format lowers it.
+def parse_fewshot_pairs(text, keys):
+    # Longest first, so "Hashtag 10" isn't read as "Hashtag 1"
+    patterns = [(key, re.compile(r"^[\s*_-]*" + re.escape(key) + r"[\s*_]*:[\s*_]*(.*)$", re.IGNORECASE))
+                for key in sorted(keys, key=len, reverse=True)]
+    pairs = []
+    current = None
+    used_lines = stray_lines = pending_stray = 0
+
+    for line in (text or "").splitlines():
+        match = next(((key, m) for key, pattern in patterns if (m := pattern.match(line))), None)
+        if match:
+            key, m = match
+            # Text between values that isn't part of one: the format wasn't followed
+            stray_lines += pending_stray
+            pending_stray = 0
+            current = {"key": key, "value": m.group(1).rstrip()}
+            pairs.append(current)
+            used_lines += 1
+        elif not line.strip():
+            current = None
+        elif current is not None:
+            current["value"] = f"{current['value']}\n{line.rstrip()}" if current["value"] else line.rstrip()
+            used_lines += 1
+        elif pairs:
+            pending_stray += 1
+
+    if not pairs or not keys:
+        return pairs, 0.0
+    counts = [sum(pair["key"] == key for pair in pairs) for key in keys]
+    found = sum(count > 0 for count in counts) / len(keys)
+    evenness = min(counts) / max(counts)
+    return pairs, found * used_lines / (used_lines + stray_lines) * evenness
+
+# "local" parses generations with parse_fewshot_pairs, and only sends the ones it isn't
+# confident about to the fit_to_spec call; "llm" always sends them
+PARSE_MODE = "local"
+
+# parse_fewshot_pairs confidence below which a generation goes to the fit_to_spec call instead
+LOCAL_PARSE_MIN_CONFIDENCE = 0.9
+
+# Split a generation into key/value pairs, locally when the layout's keys are known and the
+# text follows the fewshot format closely enough. Returns None if the parse call got no answer
+# (the circuit breaker is open, say), like structured_pairs for a response it can't read.
+def parse_generation(response, layout_text, parse_mode=None, use_cache=True):
+    if (parse_mode or PARSE_MODE) == "local":
+        pairs, confidence = parse_fewshot_pairs(response, layout_keys(layout_text))
+        if confidence >= LOCAL_PARSE_MIN_CONFIDENCE:
+            return pairs
+        logger.info("Local parse confidence %.2f, parsing with OpenAI instead", confidence)
+    layout_messages = [{"role": "user", "content": response}]
+    parsed = send_to_openai_with_tools(layout_messages, use_cache)
+    if parsed is None:
         return None
+    return extract_key_value_pairs(parsed)
+
+# Key/value pairs of a schema-constrained generation, every value of a key together like the
+# parse gives them. A key a variation lacks gets None, which the evaluation reports as missing.
+# Returns None if the response isn't an object with a list of variation objects: cut off at
+# the token limit, say, or a text-mode generation.
+def structured_pairs(response, keys):
+    try:
+        variations = json.loads(response)["variations"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return None
+    if not isinstance(variations, list) or not all(isinstance(variation, dict) for variation in variations):
+        return None
+    return [{"key": key, "value": variation.get(key)} for key in keys for variation in variations]
 
 # Define the fix_problems function
 def fix_problems(evaluation: List[Dict[str, Any]]) -> List[Tuple[str, str, int]]:
@@ -557,6 +814,114 @@ def update_grouped(grouped: List[Dict[str, Any]], key: str, index: str, new_valu
                 return True
     return False
 
+# Send every fix of one iteration to OpenAI at once, with at most max_workers in flight.
+# Returns (key, index, fixed text) in the same order as the problems.
+def dispatch_fixes(problems, keys_to_fix, indices_to_fix, line_counts, max_workers=None, use_cache=True):
+    prompts = [f"{problem}\n\nPlease return your new text, on {line_count} lines." for problem, line_count in zip(problems, line_counts)]
+    if not prompts:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers or FIX_CONCURRENCY, len(prompts))) as executor:
+        fixed_responses = list(executor.map(bind_context(lambda prompt: send_plaintext_to_openai(prompt, use_cache)), prompts))
+    return list(zip(keys_to_fix, indices_to_fix, fixed_responses))
+
+# Merge a whole round of fixes into the grouped object in one step, like update_grouped
+# does for a single value. Returns the fixes that didn't match any key and index.
+def apply_fixes(grouped: List[Dict[str, Any]], fixes: List[Tuple[str, Any, str]]) -> List[Tuple[str, Any, str]]:
+    items_by_key = {}
+    for item in grouped:
+        items_by_key.setdefault(item["key"], item)
+
+    unmatched = []
+    for key, index, new_value in fixes:
+        item = items_by_key.get(key)
+        if item is not None and index in item["values"]:
+            item["values"][index] = new_value
+        else:
+            unmatched.append((key, index, new_value))
+    return unmatched
+
+# Find the spec that applies to a key, matching case- and space-insensitively like the evaluation does
+def find_spec(key, specs):
+    formatted_key = key.replace(' ', '').lower()
+    for spec_key, spec_str in specs.items():
+        if formatted_key in spec_key.replace(' ', '').lower():
+            try:
+                return eval(spec_str)  # Convert string to dictionary safely
+            except Exception as e:
+                print(f"Error parsing spec for key {key}: {e}")
+    return None
+
+# Describe a spec's limits in words, for fix prompts
+def describe_spec(spec):
+    lines = spec["LINES"]
+    limits = [f"{lines} line{'s' if lines != 1 else ''}"]
+    for i in range(1, lines + 1):
+        lower = spec.get(f"LINE_{i}_LOWER_LIMIT")
+        upper = spec.get(f"LINE_{i}_UPPER_LIMIT")
+        if lower is not None and upper is not None:
+            limits.append(f"line {i} between {lower} and {upper} characters")
+        elif upper is not None:
+            limits.append(f"line {i} at most {upper} characters")
+    return "; ".join(limits)
+
+# Tool for fixing every failing value of a fix iteration in a single call
+fix_batch_tools = [
+    {
+        "type": "function",
+        "function": {
+            "name": "fix_values",
+            "description": "Returns the rewritten text for every item that needed fixing.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "fixes": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "key": {"type": "string", "description": "The item's key, exactly as given."},
+                                "index": {"type": "integer", "description": "The item's index, exactly as given."},
+                                "new_value": {"type": "string", "description": "The rewritten text. Separate lines with \n."},
+                            },
+                            "required": ["key", "index", "new_value"],
+                        },
+                    },
+                },
+                "required": ["fixes"],
+            },
+        }
+    }
+]
+
+# Send every failing value of an evaluation to OpenAI in one fix_values tool call.
+# Returns (key, index, new value) tuples like dispatch_fixes, or None if the call failed.
+def send_batched_fix_to_openai(evaluation, specs, use_cache=True):
+    items = []
+    for item in evaluation:
+        spec = find_spec(item["key"], specs)
+        for idx, value in item["values"].items():
+            if "reason_code" in value:
+                items.append(f"key: {item['key']}\nindex: {idx}\nproblem: {value['reason_code']}\nlimits: {describe_spec(spec)}\ntext:\n{value.get('value') or ''}")
+    if not items:
+        return []
+
+    prompt = "Rewrite each item below so it meets its limits. Keep the general meaning, but you can change it if you need to: this is for a graphic design, so it doesn't need to be exact. Return every item with its key and index unchanged.\n\n"
+    prompt += "\n\n---------\n\n".join(items)
+    try:
+        response = chat_completion(
+            use_cache=use_cache,
+            stage="fix",
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            tools=fix_batch_tools,
+            tool_choice={"type": "function", "function": {"name": "fix_values"}}
+        )
+        arguments = json.loads(response.choices[0].message.tool_calls[0].function.arguments)
+        return [(fix["key"], fix["index"], fix["new_value"]) for fix in arguments.get("fixes", [])]
+    except Exception as e:
+        print(f"An error occurred: {type(e).__name__}: {e}")
+        return None
+
 # Run the character count evaluation on an object with multiple entries
 # Run the character count evaluation on an object with multiple entries
 def evaluate_character_count_and_lines_of_group(grouped, specs):
@@ -616,17 +981,7 @@ def evaluate_character_count_and_lines_of_group(grouped, specs):
 
     for item in grouped:
         key = item["key"]
-        formatted_key = key.replace(' ', '').lower()
-        spec_key = f"{formatted_key}_specs"
-
-        spec = None
-        for spec_key, spec_str in specs.items():
-            if formatted_key in spec_key.replace(' ', '').lower():
-                try:
-                    spec = eval(spec_str)  # Convert string to dictionary safely
-                    break
-                except Exception as e:
-                    print(f"Error parsing spec for key {key}: {e}")
+        spec = find_spec(key, specs)
 
         if spec:
             evaluated_values = {}
@@ -638,6 +993,94 @@ def evaluate_character_count_and_lines_of_group(grouped, specs):
 
     return overall_result
 
+# How many layouts the image subloop generates at once
+LAYOUT_CONCURRENCY = 4
+
+# How many fix requests of one fix iteration are in flight at once
+FIX_CONCURRENCY = 8
+
+# "parallel" sends one request per failing value, "batched" sends them all in one tool call
+FIX_MODE = "parallel"
+
+# "text" generates free text in the fewshot format and parses it; "structured" has the first
+# generation return every variation's values by key, held to the layout's schema
+GENERATION_MODE = "text"
+
+# Run one layout's generate -> parse -> fix chain and return the final grouped values, plus the
+# notes the page shows about retries along the way. It doesn't call Streamlit, so several
+# layouts can run at once on worker threads. Cached responses are only used for the first
+# attempt at each step: a retry or a repeat fix needs a new answer, not the same one again.
+# first_response is a generation obtained elsewhere (e.g. from a batch) to use for the first attempt;
+# in structured mode it has to come from the schema-constrained request too.
+# parse_mode overrides PARSE_MODE for how generations are split into key/value pairs, and
+# generation_mode overrides GENERATION_MODE.
+def run_layout_chain(prompt, max_retries=3, max_iterations=5, fix_concurrency=None, fix_mode=None, use_cache=True, first_response=None, parse_mode=None, generation_mode=None):
+    messages = prompt['message']
+    specs = prompt['specs']
+    fix_mode = fix_mode or FIX_MODE
+    schema = prompt['schema'] if (generation_mode or GENERATION_MODE) == "structured" else None
+    grouped = []
+    notes = []
+
+    for retry in range(max_retries):
+        if retry == 0 and first_response:
+            response = first_response
+        else:
+            response = send_to_openai(messages, use_cache and retry == 0, schema=schema)
+        if not response:
+            # The LLM layer has already retried with backoff, so sending again straight away won't help
+            notes.append("Could not get a response from OpenAI (see the log for the error). Moving on to the next layout.")
+            break
+
+        if schema is not None:
+            # Already split by key: no parse stage
+            pairs_json = structured_pairs(response, layout_keys(prompt['layout'][0]['content']))
+        else:
+            pairs_json = parse_generation(response, prompt['layout'][0]['content'], parse_mode, use_cache)
+
+        iterations = 0
+        # A response that couldn't be read or parsed is missing every key: retry with a new generation
+        unreadable = pairs_json is None
+        missing_key = unreadable  # Flag to indicate missing key
+        grouped = group_values(pairs_json or [])
+
+        while not missing_key and iterations < max_iterations:
+            # Evaluate the grouped values based on specifications
+            evaluation = evaluate_character_count_and_lines_of_group(grouped, specs)
+
+            # Break if all criteria are met and no reason_code is present in the evaluation
+            if not any("reason_code" in value for item in evaluation for value in item['values'].values()):
+                break
+
+            # Check for missing key issue
+            if any("reason_code" in value and "The specified key is missing" in value["reason_code"] for item in evaluation for value in item['values'].values()):
+                missing_key = True
+                break  # Break the fixing loop to retry with a new generation
+
+            # Fix every identified problem at once, then merge the fixes into grouped. Batched mode
+            # asks for all of them in one call and falls back to parallel calls if that fails.
+            fix_use_cache = use_cache and iterations == 0
+            fixes = send_batched_fix_to_openai(evaluation, specs, fix_use_cache) if fix_mode == "batched" else None
+            if fixes is None:
+                problems, keys_to_fix, indices_to_fix, line_counts = fix_problems(evaluation)
+                fixes = dispatch_fixes(problems, keys_to_fix, indices_to_fix, line_counts, fix_concurrency, fix_use_cache)
+            for key, index, fixed_response in apply_fixes(grouped, fixes):
+                notes.append(f"Could not update value for {key} at index {index} with content {fixed_response}")
+
+            iterations += 1
+
+        if unreadable:
+            notes.append(f"Could not read the response. Retrying {retry + 1}/{max_retries}...")
+        elif missing_key:
+            notes.append(f"Missing key detected. Retrying {retry + 1}/{max_retries}...")
+        else:
+            break
+
+        if retry == max_retries - 1:  # If we've exhausted retries
+            notes.append("Max retries exhausted. Moving on to the next layout.")
+
+    return grouped, notes
+
 def assemble_prompt(company_tone_style, image_prompt, topic, variations, layouts_array, content_professional=None, content_casual=None, content_direct=None):
     layouts_text = ""
     response_structure = "Use this structure for the response:\nVariation n:\n"
@@ -685,33 +1128,16 @@ def get_image_from_url(url):
     response = requests.get(url)
     return Image.open(BytesIO(response.content))
 
-def query_airtable_table(base_id, table_name):
-    url = f"https://api.airtable.com/v0/{base_id}/{table_name}"
-    
-    headers = {
-        "Authorization": f"Bearer {st.secrets['AIRTABLE_SECOND_TOKEN']}",
-        "Content-Type": "application/json"
-    }
-    
-    all_records = []
-    params = {}
-
-    while True:
-        response = requests.get(url, headers=headers, params=params)
-        
-        if response.status_code == 200:
-            data = response.json()
-            all_records.extend(data['records'])
-            
-            if 'offset' in data:
-                params['offset'] = data['offset']
-            else:
-                break
-        else:
-            st.error(f"Error fetching data from {table_name}: {response.status_code}")
-            return None
-
-    return all_records
+# Fetch a whole table from the content base. filter_formula, if given, is sent as filterByFormula.
+def query_airtable_table(base_id, table_name, filter_formula=None):
+    params = {"filterByFormula": filter_formula} if filter_formula else None
+    try:
+        if table_name in FIELD_MANIFEST:
+            return fetch_manifest_records(base_id, table_name, token_secret="AIRTABLE_SECOND_TOKEN", params=params)
+        return list_records(base_id, table_name, params=params, token_secret="AIRTABLE_SECOND_TOKEN")
+    except AirtableError as e:
+        st.error(f"Error fetching data from {table_name}: {e.status_code}")
+        return None
 
 def get_unique_content_kits(content_kits_records):
     return sorted(set(record['fields'].get('Content Kit', 'Unknown') for record in content_kits_records))
@@ -751,6 +1177,42 @@ def create_filter_json(selected_kits, selected_steps, selected_content_types, se
         }
     }
 
+# Compile create_filter_json output into a filterByFormula expression for the content table,
+# so only rows from the selected kits cross the network. Each clause keeps a superset of what
+# process_content_table keeps, and that function still does the exact filtering. Values that
+# can't be quoted safely, and fields the schema registry doesn't list, are left out of the formula.
+def compile_content_filter_formula(filter_json, base_id):
+    known_fields = get_schema_registry().fields(base_id, "content")
+
+    def has_field(name):
+        return not known_fields or name in known_fields
+
+    def find_any(values, field_names):
+        quoted = [formula_string(value) for value in values]
+        field_names = [name for name in field_names if has_field(name)]
+        if not values or None in quoted or not field_names:
+            return None
+        return or_formula(*[f"FIND({value}, {{{name}}} & '')" for value in quoted for name in field_names])
+
+    selected_kits = filter_json.get('selected_kits', [])
+    filters = filter_json.get('filters', {})
+    clauses = []
+
+    # Records without kits are grouped as 'Uncategorized', which no formula can match
+    if 'Uncategorized' not in selected_kits:
+        clauses.append(find_any(selected_kits, ['Content Kits']))
+
+    if has_field('Step'):
+        steps = [formula_string(step) for step in filters.get('step') or []]
+        if None not in steps:
+            clauses.append(or_formula(*[f"{{Step}} = {step}" for step in steps]))
+        clauses.append("{Step} != ''")
+
+    clauses.append(find_any(filters.get('content_type') or [], ['Content Type (from Content Type)', 'Content Type']))
+    clauses.append(find_any(filters.get('type') or [], ['Type']))
+
+    return and_formula(*clauses)
+
 def process_content_table(content_records, content_kits_records, filter_json):
     if not content_records or not content_kits_records:
         return {}
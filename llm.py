@@ -0,0 +1,311 @@
+"""
+The one way the app talks to OpenAI.
+
+Every chat completion goes through chat_completion or chat_completion_stream here,
+so they all share one pooled client, the response cache, rate limiting, the retry
+policy and circuit breaker, timeouts and the call hooks.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+import openai
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+
+from llm_cache import ResponseCache, request_key
+from llm_cassette import CassetteMiss, client_options, get_cassette
+from llm_ratelimit import estimate_tokens, get_rate_limiter
+from llm_retry import MAX_ATTEMPTS, CircuitOpenError, backoff_delay, get_circuit_breaker, is_retryable
+
+logger = logging.getLogger(__name__)
+
+# Model for each kind of call; set LLM_MODEL_<ROLE> (e.g. LLM_MODEL_PARSE) to override one
+MODELS = {
+    # First-pass generation and fixes
+    "generate": "gpt-4-turbo",
+    # Splitting a generation into key/value pairs with fit_to_spec
+    "parse": "gpt-4o",
+    # Tool-forced JSON: blueprints, FAQ and one-pager JSON
+    "structured": "gpt-4o-2024-08-06",
+    # Turning CSV exports into plaintext
+    "convert": "gpt-4o",
+}
+
+# Seconds a call may take before it's abandoned, unless the caller passes timeout=
+DEFAULT_TIMEOUT = 300
+
+# How many 429s a request waits out in its model's queue before the error is passed on
+MAX_THROTTLE_WAITS = 10
+
+# What chat_completion and chat_completion_stream raise when they can't get an answer: OpenAI's
+# own errors, an open circuit, or a replayed request the cassette has no recording of
+LLM_ERRORS = (openai.APIError, CircuitOpenError, CassetteMiss)
+
+
+def model_for(role: str) -> str:
+    return os.environ.get(f"LLM_MODEL_{role.upper()}", MODELS[role])
+
+
+class CallEvent(NamedTuple):
+    """What a hook is told about each call once it has finished or failed."""
+    request: Dict[str, Any]
+    stream: bool
+    cached: bool
+    elapsed: float
+    response: Optional[ChatCompletion]
+    error: Optional[BaseException]
+    # The pipeline stage the caller tagged the call with, e.g. "generate", "parse" or "fix"
+    stage: Optional[str] = None
+    # Seconds until the first streamed text arrived (the whole call for non-streamed ones)
+    ttft: Optional[float] = None
+    # Requests sent again after a retryable error or a 429
+    retries: int = 0
+
+
+_client: Optional[openai.OpenAI] = None
+_client_lock = threading.Lock()
+_response_cache = ResponseCache()
+_hooks: List[Callable[[CallEvent], None]] = []
+
+
+def get_openai_client() -> openai.OpenAI:
+    # Created on first use, when Streamlit has put OPENAI_API_KEY from the secrets into the environment.
+    # One client for the whole process, so every call reuses its connection pool. Its own
+    # retries are off: the rate limiter and the retry policy in _send handle failures.
+    # LLM_TRANSPORT=synthetic points it at a local stand-in instead (see llm_cassette).
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = openai.OpenAI(timeout=DEFAULT_TIMEOUT, max_retries=0, **client_options())
+    return _client
+
+
+def get_response_cache() -> ResponseCache:
+    return _response_cache
+
+
+def add_hook(hook: Callable[[CallEvent], None]):
+    """Call hook(event) after every chat completion, from whichever thread made it."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[CallEvent], None]):
+    if hook in _hooks:
+        _hooks.remove(hook)
+
+
+def _emit(event: CallEvent):
+    for hook in list(_hooks):
+        try:
+            hook(event)
+        except Exception:
+            # A broken hook mustn't fail the call it's observing
+            logger.exception("LLM call hook failed")
+
+
+def prompt_cache_usage(response: ChatCompletion) -> Tuple[int, int]:
+    """A response's prompt tokens, and how many of them OpenAI served from its prompt cache."""
+    usage = response.usage
+    if usage is None:
+        return 0, 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    return usage.prompt_tokens or 0, getattr(details, "cached_tokens", None) or 0
+
+
+def _log_usage(response: ChatCompletion):
+    prompt_tokens, cached_tokens = prompt_cache_usage(response)
+    if prompt_tokens:
+        logger.info("%s: %d prompt tokens, %d from the prompt cache", response.model, prompt_tokens, cached_tokens)
+
+
+def _send(request: Dict[str, Any], timeout: Optional[float], stream: bool = False, counts: Optional[Dict[str, int]] = None):
+    """
+    Send a request with the retry policy: retryable errors (timeouts, dropped connections,
+    5xx) are tried again up to MAX_ATTEMPTS times with jittered exponential backoff, fatal
+    ones are raised at once. Sustained failures open the model's circuit breaker, after which
+    calls fail fast with CircuitOpenError until it lets a trial call through.
+    Retries, including 429s waited out, are counted in counts["retries"].
+    """
+    counts = counts if counts is not None else {}
+    counts.setdefault("retries", 0)
+    breaker = get_circuit_breaker(request["model"])
+    for attempt in range(MAX_ATTEMPTS):
+        breaker.before_call()
+        try:
+            result = _send_once(request, timeout, stream, counts)
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.record_fatal()
+                raise
+            breaker.record_failure()
+            if attempt == MAX_ATTEMPTS - 1:
+                raise
+            delay = backoff_delay(attempt, e)
+            logger.warning("OpenAI call to %s failed (%s); retrying in %.1fs", request["model"], e, delay)
+            time.sleep(delay)
+            counts["retries"] += 1
+            continue
+        breaker.record_success()
+        return result
+
+
+# The raw OpenAI call, or its recording when LLM_TRANSPORT is record or replay
+def _create(request: Dict[str, Any], timeout: Optional[float], stream: bool):
+    # Streams only report usage (and so cached tokens) when asked to, in a last chunk
+    send = lambda: get_openai_client().chat.completions.with_raw_response.create(
+        stream=stream, timeout=timeout or DEFAULT_TIMEOUT,
+        **({"stream_options": {"include_usage": True}} if stream else {}), **request
+    )
+    cassette = get_cassette()
+    return cassette.create(request, stream, send) if cassette is not None else send()
+
+
+def _send_once(request: Dict[str, Any], timeout: Optional[float], stream: bool, counts: Dict[str, int]):
+    """
+    Send a request once its model's rate limiter admits it. A 429 sends it back to the
+    queue, which waits out the reset instead of failing the call. Returns the limiter,
+    which the caller must release() once the response has been read, and the parsed response.
+    """
+    limiter = get_rate_limiter(request["model"])
+    cost = estimate_tokens(request)
+    for attempt in range(MAX_THROTTLE_WAITS + 1):
+        limiter.acquire(cost)
+        try:
+            raw = _create(request, timeout, stream)
+            response = raw.parse()
+        except openai.RateLimitError as e:
+            limiter.throttled(e.response.headers)
+            # An exhausted quota won't come back by waiting
+            if e.code == "insufficient_quota" or attempt == MAX_THROTTLE_WAITS:
+                raise
+            counts["retries"] += 1
+            continue
+        except Exception:
+            limiter.release(success=False)
+            raise
+        limiter.observe(raw.headers)
+        return limiter, response
+
+
+def chat_completion(use_cache: bool = True, timeout: Optional[float] = None, stage: Optional[str] = None,
+                    **request) -> ChatCompletion:
+    """
+    chat.completions.create, answered from the response cache when this exact
+    request (model, messages, tools, sampling params) has been sent before.
+
+    use_cache=False always calls OpenAI, and the fresh response replaces the cached one,
+    so a regenerate gets a new answer and later identical requests see it. stage tags
+    the call for the hooks (and so the telemetry); it isn't sent and isn't part of the key.
+    """
+    started = time.perf_counter()
+    key = request_key(request)
+    if use_cache:
+        cached = _response_cache.get(key)
+        if cached is not None:
+            response = ChatCompletion.model_validate_json(cached)
+            elapsed = time.perf_counter() - started
+            _emit(CallEvent(request, False, True, elapsed, response, None, stage, elapsed))
+            return response
+
+    counts = {"retries": 0}
+    try:
+        limiter, response = _send(request, timeout, counts=counts)
+        limiter.release()
+    except Exception as e:
+        _emit(CallEvent(request, False, False, time.perf_counter() - started, None, e, stage, None, counts["retries"]))
+        raise
+    _log_usage(response)
+    _response_cache.set(key, response.model_dump_json())
+    elapsed = time.perf_counter() - started
+    _emit(CallEvent(request, False, False, elapsed, response, None, stage, elapsed, counts["retries"]))
+    return response
+
+
+def chat_completion_stream(use_cache: bool = True, timeout: Optional[float] = None, stage: Optional[str] = None,
+                           **request) -> Iterator[str]:
+    """
+    Streaming chat_completion: yields the response text as it arrives.
+
+    A cached response is yielded in one piece. Once a stream finishes, the assembled
+    text is cached under the same key as the equivalent non-streamed request, so
+    either kind of call can reuse it. A stream abandoned part way isn't cached.
+    A stream that breaks before any text arrived is retried like a failed call; one that
+    breaks part way raises, since its text has already been yielded.
+    """
+    started = time.perf_counter()
+    key = request_key(request)
+    if use_cache:
+        cached = _response_cache.get(key)
+        if cached is not None:
+            response = ChatCompletion.model_validate_json(cached)
+            elapsed = time.perf_counter() - started
+            _emit(CallEvent(request, True, True, elapsed, response, None, stage, elapsed))
+            yield response.choices[0].message.content or ""
+            return
+
+    ttft = None
+    counts = {"retries": 0}
+    breaker = get_circuit_breaker(request["model"])
+    for attempt in range(MAX_ATTEMPTS):
+        parts = []
+        response_id, created, model, finish_reason, usage = "", 0, request.get("model", ""), None, None
+        try:
+            limiter, stream = _send(request, timeout, stream=True, counts=counts)
+        except Exception as e:
+            _emit(CallEvent(request, True, False, time.perf_counter() - started, None, e, stage, None, counts["retries"]))
+            raise
+        # The request holds its concurrency slot until the stream has been read to the end
+        success = False
+        try:
+            for chunk in stream:
+                response_id, created, model = chunk.id, chunk.created, chunk.model
+                usage = chunk.usage or usage
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                finish_reason = choice.finish_reason or finish_reason
+                if choice.delta.content:
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                    parts.append(choice.delta.content)
+                    yield choice.delta.content
+            success = True
+        except Exception as e:
+            # A stream that breaks after opening counts against the model like a failed call
+            retryable = is_retryable(e)
+            if retryable:
+                breaker.record_failure()
+            else:
+                breaker.record_fatal()
+            # Until the caller has seen some text the stream can start over; after that it can't
+            if retryable and not parts and attempt < MAX_ATTEMPTS - 1:
+                delay = backoff_delay(attempt, e)
+                logger.warning("OpenAI stream from %s failed (%s); retrying in %.1fs", request["model"], e, delay)
+                time.sleep(delay)
+                counts["retries"] += 1
+                continue
+            _emit(CallEvent(request, True, False, time.perf_counter() - started, None, e, stage, ttft, counts["retries"]))
+            raise
+        finally:
+            limiter.release(success)
+        break
+
+    response = ChatCompletion(
+        id=response_id,
+        object="chat.completion",
+        created=created,
+        model=model,
+        choices=[Choice(
+            index=0,
+            finish_reason=finish_reason or "stop",
+            message=ChatCompletionMessage(role="assistant", content="".join(parts)),
+        )],
+        usage=usage,
+    )
+    _log_usage(response)
+    _response_cache.set(key, response.model_dump_json())
+    _emit(CallEvent(request, True, False, time.perf_counter() - started, response, None, stage, ttft, counts["retries"]))
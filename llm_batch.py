@@ -0,0 +1,88 @@
+"""
+Run chat completions through the OpenAI Batch API.
+
+Requests are written to a JSONL file, uploaded and submitted as one batch, which
+OpenAI completes within BATCH_COMPLETION_WINDOW at a lower price than live calls.
+Nothing has to stay connected meanwhile: keep the batch ID and pick the results up
+with batch_results once retrieve_batch reports it completed.
+"""
+import json
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+from openai.types import Batch
+from openai.types.chat import ChatCompletion
+
+from llm import get_openai_client
+
+# Where submitted batch files are kept
+BATCH_DIR = os.environ.get("LLM_BATCH_DIR", ".llm_batches")
+BATCH_COMPLETION_WINDOW = "24h"
+# Seconds between status checks in wait_for_batch
+BATCH_POLL_INTERVAL = 30
+BATCH_ENDPOINT = "/v1/chat/completions"
+
+# Statuses a batch doesn't leave
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def write_batch_file(requests_by_id: Dict[str, Dict[str, Any]], path: Optional[str] = None) -> str:
+    """Write one Batch API line per request, keyed by its custom ID, and return the file's path."""
+    if path is None:
+        os.makedirs(BATCH_DIR, exist_ok=True)
+        path = os.path.join(BATCH_DIR, f"batch-{int(time.time())}.jsonl")
+    with open(path, "w") as f:
+        for custom_id, request in requests_by_id.items():
+            f.write(json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": request}) + "\n")
+    return path
+
+
+def submit_batch(path: str, metadata: Optional[Dict[str, str]] = None) -> Batch:
+    client = get_openai_client()
+    with open(path, "rb") as f:
+        input_file = client.files.create(file=f, purpose="batch")
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata=metadata,
+    )
+
+
+def retrieve_batch(batch_id: str) -> Batch:
+    return get_openai_client().batches.retrieve(batch_id)
+
+
+def wait_for_batch(batch_id: str, poll_interval: float = BATCH_POLL_INTERVAL,
+                   on_poll: Optional[Callable[[Batch], None]] = None) -> Batch:
+    """Poll until the batch reaches a final status; on_poll(batch) is called after every check."""
+    while True:
+        batch = retrieve_batch(batch_id)
+        if on_poll:
+            on_poll(batch)
+        if batch.status in FINAL_STATUSES:
+            return batch
+        time.sleep(poll_interval)
+
+
+def batch_results(batch: Batch) -> Dict[str, Optional[ChatCompletion]]:
+    """
+    The response to every request of a completed batch, by custom ID.
+    Requests that failed map to None, like a failed send_to_openai.
+    """
+    client = get_openai_client()
+    results: Dict[str, Optional[ChatCompletion]] = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") == 200 and not item.get("error"):
+                results[item["custom_id"]] = ChatCompletion.model_validate(response["body"])
+            else:
+                results.setdefault(item["custom_id"], None)
+    return results
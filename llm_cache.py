@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+# Where cached OpenAI responses are kept, and how much disk they may use before
+# the least recently used ones are evicted
+LLM_CACHE_PATH = os.environ.get("LLM_CACHE_PATH", ".llm_cache.sqlite3")
+LLM_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response_json TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+# Content address of a request: a hash of the model, messages, tools and sampling params
+def request_key(request: Dict[str, Any]) -> str:
+    # Messages can be SDK objects (an assistant message passed back in), so dump those to dicts
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"),
+                           default=lambda o: o.model_dump() if hasattr(o, "model_dump") else str(o))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class ResponseCache:
+    """
+    Disk-backed LRU cache of chat completion responses, keyed by request_key.
+
+    Responses are stored as JSON; once the total size passes max_bytes the least
+    recently used entries are evicted.
+    """
+
+    def __init__(self, path: str = LLM_CACHE_PATH, max_bytes: int = LLM_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            with self._init_lock:
+                if not self._initialized:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.executescript(_SCHEMA)
+                    self._initialized = True
+        return conn
+
+    def get(self, key: str) -> Optional[str]:
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT response_json FROM responses WHERE key = ?", (key,)).fetchone()
+                if row:
+                    conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        finally:
+            conn.close()
+        return row[0] if row else None
+
+    def set(self, key: str, response_json: str):
+        size = len(response_json.encode())
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                    (key, response_json, size, time.time()),
+                )
+                (total,) = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+                if total > self.max_bytes:
+                    self._evict(conn, total - self.max_bytes)
+        finally:
+            conn.close()
+
+    def _evict(self, conn: sqlite3.Connection, excess: int):
+        freed = 0
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_used"):
+            if freed >= excess:
+                break
+            stale.append((key,))
+            freed += size
+        conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+
+    def clear(self):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM responses")
+        finally:
+            conn.close()
@@ -0,0 +1,262 @@
+"""
+Record and replay OpenAI calls, so the generate -> parse -> fix pipeline can be
+benchmarked and regression-tested without a live key.
+
+LLM_TRANSPORT picks how the LLM layer reaches OpenAI:
+
+    live       call OpenAI (the default)
+    record     call OpenAI, and append every request and its response (with its timing
+               and rate limit headers) to the cassette at LLM_CASSETTE_PATH
+    replay     answer from the cassette without the network. Each call takes its recorded
+               time multiplied by LLM_REPLAY_LATENCY_SCALE (1 for the original timing, 0 for
+               none) and streams replay chunk by chunk at their recorded offsets.
+    synthetic  call an openai_standin started in-process, which answers generation prompts
+               with fewshot-format text and parse requests with fit_to_spec tool calls
+
+Recordings are keyed like the response cache, plus whether the call streamed. A request
+sent several times replays its recordings in order, then repeats the last one. Only
+successful responses are recorded: errors, 429s and retries happen live, not on replay.
+
+Usage:
+    LLM_TRANSPORT=synthetic python llm_cassette.py bench
+    LLM_TRANSPORT=record python llm_cassette.py bench --flow autotest    # needs OPENAI_API_KEY
+    LLM_TRANSPORT=replay LLM_REPLAY_LATENCY_SCALE=1 python llm_cassette.py bench --flow autotest
+
+The pages run the same way: LLM_TRANSPORT=replay streamlit run Home.py. tests/test_llm_cassette.py
+records the layout chain against the stand-in and checks replay gives the same results.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from llm_cache import request_key
+
+TRANSPORTS = ("live", "record", "replay", "synthetic")
+LLM_TRANSPORT = os.environ.get("LLM_TRANSPORT", "live")
+LLM_CASSETTE_PATH = os.environ.get("LLM_CASSETTE_PATH", "llm_cassette.jsonl")
+LLM_REPLAY_LATENCY_SCALE = float(os.environ.get("LLM_REPLAY_LATENCY_SCALE", "1"))
+
+# The synthetic stand-in's seconds before each response, completion tokens per second, and
+# share of generated values that break their limits (so the fix stage has work to do)
+LLM_SYNTHETIC_LATENCY = float(os.environ.get("LLM_SYNTHETIC_LATENCY", "0.5"))
+LLM_SYNTHETIC_TOKEN_RATE = float(os.environ.get("LLM_SYNTHETIC_TOKEN_RATE", "50"))
+LLM_SYNTHETIC_NONCOMPLIANT = float(os.environ.get("LLM_SYNTHETIC_NONCOMPLIANT", "0.25"))
+
+# Response headers kept with a recording, so the rate limiter sees the same limits on replay
+RECORDED_HEADERS = (
+    "x-ratelimit-limit-requests",
+    "x-ratelimit-remaining-requests",
+    "x-ratelimit-reset-requests",
+    "x-ratelimit-limit-tokens",
+    "x-ratelimit-remaining-tokens",
+    "x-ratelimit-reset-tokens",
+)
+
+
+class CassetteMiss(Exception):
+    """Raised in replay mode for a request the cassette has no recording of."""
+
+    def __init__(self, request: Dict[str, Any]):
+        super().__init__(f"No recording of this {request.get('model')} request in {LLM_CASSETTE_PATH}; "
+                         "record it with LLM_TRANSPORT=record first")
+
+
+class _RawResponse:
+    """What _send_once uses of the SDK's raw response: the headers, and parse()."""
+
+    def __init__(self, headers: Dict[str, str], parse: Callable[[], Any]):
+        self.headers = headers
+        self.parse = parse
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str, latency_scale: float = 1.0):
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._recordings: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        self._replayed: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        if mode == "replay":
+            with open(path) as f:
+                for line in filter(None, (line.strip() for line in f)):
+                    entry = json.loads(line)
+                    self._recordings[entry["key"]].append(entry)
+
+    def create(self, request: Dict[str, Any], stream: bool, send: Callable[[], Any]):
+        """Stands in for with_raw_response.create: send() makes the live call, if one is needed."""
+        key = request_key({**request, "stream": stream})
+        if self.mode == "replay":
+            return self._replay(key, request, stream)
+        return self._record(key, request, stream, send)
+
+    def _record(self, key: str, request: Dict[str, Any], stream: bool, send: Callable[[], Any]) -> _RawResponse:
+        started = time.perf_counter()
+        raw = send()
+        entry = {
+            "key": key,
+            "request": request,
+            "stream": stream,
+            # For a stream, the time until the response started; its chunks carry their own offsets
+            "elapsed": time.perf_counter() - started,
+            "headers": {name: raw.headers[name] for name in RECORDED_HEADERS if name in raw.headers},
+        }
+
+        def parse():
+            response = raw.parse()
+            if stream:
+                return self._record_stream(entry, response, started)
+            entry["elapsed"] = time.perf_counter() - started
+            self._write({**entry, "response": response.model_dump(mode="json")})
+            return response
+
+        return _RawResponse(raw.headers, parse)
+
+    # Pass the chunks through, noting when each arrived; a stream abandoned part way isn't recorded
+    def _record_stream(self, entry: Dict[str, Any], stream: Iterator[ChatCompletionChunk], started: float):
+        chunks = []
+        for chunk in stream:
+            chunks.append({"offset": time.perf_counter() - started, "chunk": chunk.model_dump(mode="json")})
+            yield chunk
+        self._write({**entry, "chunks": chunks})
+
+    def _write(self, entry: Dict[str, Any]):
+        with self._lock:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def _replay(self, key: str, request: Dict[str, Any], stream: bool) -> _RawResponse:
+        started = time.perf_counter()
+        with self._lock:
+            entries = self._recordings.get(key)
+            if not entries:
+                raise CassetteMiss(request)
+            entry = entries[min(self._replayed[key], len(entries) - 1)]
+            self._replayed[key] += 1
+        time.sleep(entry["elapsed"] * self.latency_scale)
+        if stream:
+            return _RawResponse(entry["headers"], lambda: self._replay_stream(entry, started))
+        return _RawResponse(entry["headers"], lambda: ChatCompletion.model_validate(entry["response"]))
+
+    def _replay_stream(self, entry: Dict[str, Any], started: float) -> Iterator[ChatCompletionChunk]:
+        for item in entry["chunks"]:
+            delay = started + item["offset"] * self.latency_scale - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            yield ChatCompletionChunk.model_validate(item["chunk"])
+
+
+_cassette: Optional[Cassette] = None
+_standin_url: Optional[str] = None
+_transport_lock = threading.Lock()
+
+
+def _check_transport():
+    if LLM_TRANSPORT not in TRANSPORTS:
+        raise ValueError(f"LLM_TRANSPORT must be one of {', '.join(TRANSPORTS)}, not {LLM_TRANSPORT!r}")
+
+
+def get_cassette() -> Optional[Cassette]:
+    """The cassette calls go through in record and replay mode; None when they go straight to a server."""
+    global _cassette
+    _check_transport()
+    if LLM_TRANSPORT not in ("record", "replay"):
+        return None
+    with _transport_lock:
+        if _cassette is None:
+            _cassette = Cassette(LLM_CASSETTE_PATH, LLM_TRANSPORT, LLM_REPLAY_LATENCY_SCALE)
+    return _cassette
+
+
+def client_options() -> Dict[str, Any]:
+    """
+    Extra openai.OpenAI arguments for the transport. In synthetic mode that's the address of a
+    stand-in started on a background thread the first time it's asked for, and a dummy key.
+    """
+    global _standin_url
+    _check_transport()
+    if LLM_TRANSPORT != "synthetic":
+        return {}
+    with _transport_lock:
+        if _standin_url is None:
+            from openai_standin import StandinConfig, serve
+
+            server = serve(StandinConfig(latency=LLM_SYNTHETIC_LATENCY, token_rate=LLM_SYNTHETIC_TOKEN_RATE,
+                                         noncompliant=LLM_SYNTHETIC_NONCOMPLIANT), port=0)
+            _standin_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    return {"base_url": _standin_url, "api_key": "synthetic"}
+
+
+# The fixture Poster layouts, their layout chain prompts and the content prompts, built the way the pages build them
+def fixture_prompts(variations: int = 3, topic: str = "Welcoming our new head of finance"):
+    from airtable_standin import FIXTURES_DIR
+    from helpers import (add_specs, build_content_messages, generate_prompts_array_with_variations,
+                         get_selected_layouts_array, process_table_data)
+
+    tables_dir = os.path.join(FIXTURES_DIR, "appbJ9Bt0YNuBafT4", "tables")
+    with open(os.path.join(tables_dir, "Poster.json")) as f:
+        layouts = json.load(f)
+    with open(os.path.join(tables_dir, "Content Types.json")) as f:
+        content_type = next(r["fields"] for r in json.load(f) if r["fields"].get("Content Type") == "Poster")
+
+    edited_json = add_specs(json.loads(process_table_data(layouts).to_json(orient="records")))
+    layout_numbers = ", ".join(str(entry["Layout Number"]) for entry in edited_json)
+    layouts_array = get_selected_layouts_array(edited_json, layout_numbers)
+    prompts = generate_prompts_array_with_variations(topic, content_type["Image Prompt"], layouts_array, variations)
+    content_messages = [
+        build_content_messages("Friendly and clear.", content_type[name], topic, variations)
+        for name in ("Content Professional", "Content Casual", "Content Direct") if content_type.get(name)
+    ]
+    return layouts_array, prompts, content_messages
+
+
+# Time the Generate or Autotest flow over the fixture Poster layouts with whichever transport is set.
+# Responses aren't taken from the response cache, so every call goes through the transport.
+def bench(flow: str = "generate", variations: int = 3, generation_mode: Optional[str] = None,
+          parse_mode: Optional[str] = None, topic: str = "Welcoming our new head of finance"):
+    from concurrent.futures import ThreadPoolExecutor
+
+    from helpers import LAYOUT_CONCURRENCY, run_layout_chain, send_to_openai, stream_to_openai
+    from llm_telemetry import bind_context, telemetry_run
+
+    layouts_array, prompts, content_messages = fixture_prompts(variations, topic)
+    started = time.perf_counter()
+    with telemetry_run() as telemetry:
+        if flow == "generate":
+            # Layouts side by side, then the content prompts streamed, like the Generate page
+            with ThreadPoolExecutor(max_workers=LAYOUT_CONCURRENCY) as executor:
+                results = list(executor.map(bind_context(
+                    lambda prompt: run_layout_chain(prompt, use_cache=False, generation_mode=generation_mode, parse_mode=parse_mode)), prompts))
+            for messages in content_messages:
+                "".join(stream_to_openai(messages, use_cache=False, stage="content"))
+        else:
+            # One layout at a time, then the content prompts, like Autotest
+            results = [run_layout_chain(prompt, use_cache=False, generation_mode=generation_mode, parse_mode=parse_mode)
+                       for prompt in prompts]
+            for messages in content_messages:
+                send_to_openai(messages, use_cache=False, stage="content")
+    elapsed = time.perf_counter() - started
+
+    for layout, (grouped, notes) in zip(layouts_array, results):
+        print(f"{list(layout.keys())[0]}: {sum(len(group['values']) for group in grouped)} values, {len(notes)} notes")
+    print(f"{flow} flow over {len(prompts)} layouts took {elapsed:.2f}s ({LLM_TRANSPORT} transport)")
+    print(telemetry.headline())
+    for row in telemetry.summary():
+        print(json.dumps(row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the LLM pipeline through the configured transport")
+    parser.add_argument("command", choices=["bench"])
+    parser.add_argument("--flow", choices=["generate", "autotest"], default="generate")
+    parser.add_argument("--variations", type=int, default=3)
+    parser.add_argument("--generation-mode", choices=["text", "structured"])
+    parser.add_argument("--parse-mode", choices=["local", "llm"])
+    args = parser.parse_args()
+    bench(args.flow, args.variations, args.generation_mode, args.parse_mode)
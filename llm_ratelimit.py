@@ -0,0 +1,172 @@
+import json
+import re
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional
+
+# Concurrency a model starts at before any responses have come back, and the range AIMD keeps it in
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 32
+
+# Completion tokens assumed for a request that doesn't set max_tokens, when charging the token bucket
+DEFAULT_COMPLETION_TOKENS = 1000
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+# Parse a reset header like "1s", "6m0s" or "20ms" into seconds
+def parse_reset(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+# Rough token count of a request: prompt characters / 4, plus the completion it may produce
+def estimate_tokens(request: Dict[str, Any]) -> int:
+    prompt = json.dumps(request.get("messages", []), default=str) + json.dumps(request.get("tools", []), default=str)
+    completion = request.get("max_tokens") or request.get("max_completion_tokens") or DEFAULT_COMPLETION_TOKENS
+    return len(prompt) // 4 + completion
+
+
+class HeaderBucket:
+    """
+    Token bucket mirroring one of OpenAI's per-minute limits (requests or tokens).
+
+    Unlimited until the first response reports the limit; after that every response
+    resets the level to what the server says is remaining, and it refills at limit/60 per second.
+    """
+
+    def __init__(self):
+        self.capacity: Optional[float] = None
+        self.level = 0.0
+        self.updated = 0.0
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def update(self, limit: Optional[str], remaining: Optional[str], now: float):
+        try:
+            self.capacity = float(limit)
+            self.level = float(remaining)
+        except (TypeError, ValueError):
+            return
+        self.updated = now
+
+    # Seconds until amount is available (0 if it is now)
+    def wait_time(self, amount: float, now: float) -> float:
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)  # A request bigger than the whole limit waits for a full bucket
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / (self.capacity / 60)
+
+    def take(self, amount: float):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+
+class AdaptiveLimiter:
+    """
+    Admission control for one model, driven by the x-ratelimit-* response headers.
+
+    acquire() queues a request until a concurrency slot and enough request and token
+    budget are free. Concurrency grows by about one per round of successful calls and
+    halves on a 429 (AIMD), so it settles just under the account's limit.
+    """
+
+    def __init__(self, initial_concurrency: float = INITIAL_CONCURRENCY,
+                 min_concurrency: float = MIN_CONCURRENCY, max_concurrency: float = MAX_CONCURRENCY):
+        self.concurrency = float(initial_concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.requests = HeaderBucket()
+        self.tokens = HeaderBucket()
+        self.blocked_until = 0.0
+        self._cond = threading.Condition()
+        self._stats = {"requests": 0, "throttled": 0, "queue_wait": 0.0}
+
+    # Wait for a slot and budget for a request of about cost tokens; returns the seconds waited
+    def acquire(self, cost: int) -> float:
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = max(self.blocked_until - now, self.requests.wait_time(1, now), self.tokens.wait_time(cost, now))
+                if wait <= 0 and self.in_flight < max(int(self.concurrency), self.min_concurrency):
+                    self.requests.take(1)
+                    self.tokens.take(cost)
+                    self.in_flight += 1
+                    waited = time.monotonic() - started
+                    self._stats["requests"] += 1
+                    self._stats["queue_wait"] += waited
+                    return waited
+                # A release wakes us early when a slot frees up
+                self._cond.wait(timeout=wait if wait > 0 else None)
+
+    # Sync the buckets with the rate limit headers of a response (or of a 429)
+    def observe(self, headers: Optional[Mapping[str, str]]):
+        if not headers:
+            return
+        with self._cond:
+            now = time.monotonic()
+            self.requests.update(headers.get("x-ratelimit-limit-requests"), headers.get("x-ratelimit-remaining-requests"), now)
+            self.tokens.update(headers.get("x-ratelimit-limit-tokens"), headers.get("x-ratelimit-remaining-tokens"), now)
+
+    # Give the slot back; a success grows concurrency additively, a failure leaves it alone
+    def release(self, success: bool = True):
+        with self._cond:
+            self.in_flight -= 1
+            if success:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._cond.notify_all()
+
+    # Give the slot back after a 429: halve concurrency and hold every request until the limit resets
+    def throttled(self, headers: Optional[Mapping[str, str]] = None):
+        headers = headers or {}
+        self.observe(headers)
+        pause = parse_reset(headers.get("retry-after")) or max(
+            parse_reset(headers.get("x-ratelimit-reset-requests")) or 0,
+            parse_reset(headers.get("x-ratelimit-reset-tokens")) or 0,
+        ) or 1.0
+        with self._cond:
+            self.in_flight -= 1
+            self._stats["throttled"] += 1
+            self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {**self._stats, "concurrency": round(self.concurrency, 2), "in_flight": self.in_flight,
+                    "requests_remaining": self.requests.level if self.requests.capacity else None,
+                    "tokens_remaining": self.tokens.level if self.tokens.capacity else None}
+
+
+_limiters: Dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+# OpenAI limits each model separately, so each gets its own limiter
+def get_rate_limiter(model: str) -> AdaptiveLimiter:
+    with _limiters_lock:
+        if model not in _limiters:
+            _limiters[model] = AdaptiveLimiter()
+        return _limiters[model]
+
+
+def rate_limiter_stats() -> Dict[str, Dict[str, Any]]:
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {model: limiter.stats() for model, limiter in limiters.items()}
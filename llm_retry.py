@@ -0,0 +1,117 @@
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import openai
+
+from llm_ratelimit import parse_reset
+
+# Attempts per call (the first one included) before a retryable error is passed on
+MAX_ATTEMPTS = 4
+# Exponential backoff: attempt n waits a random time up to min(BACKOFF_MAX, BACKOFF_BASE * 2 ** n)
+BACKOFF_BASE = 1
+BACKOFF_MAX = 30
+
+# Consecutive retryable failures that open a model's circuit, and how long it stays open
+# before one trial call is let through
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling OpenAI while a model's circuit is open."""
+
+    def __init__(self, model: str, retry_in: float):
+        self.model = model
+        self.retry_in = retry_in
+        super().__init__(f"OpenAI calls to {model} are paused after repeated failures; retrying in {retry_in:.0f}s")
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Whether an error is worth trying again: timeouts, dropped connections, 408/409
+    and 5xx are; bad requests, auth and permission errors, unknown models and an
+    exhausted quota will fail the same way every time.
+    """
+    if isinstance(error, openai.RateLimitError):
+        # 429s are already waited out by the rate limiter; reaching here means it gave up
+        return False
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+
+# Full jitter: a uniform wait up to the exponential cap, or what the server asked for in retry-after
+def backoff_delay(attempt: int, error: Optional[BaseException] = None) -> float:
+    response = getattr(error, "response", None)
+    retry_after = parse_reset(response.headers.get("retry-after")) if response is not None else None
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_MAX)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a model that keeps failing.
+
+    Closed: calls go through. After failure_threshold consecutive retryable failures
+    it opens and calls fail at once with CircuitOpenError. After reset_timeout it lets
+    one trial call through (half-open): success closes it, failure opens it again.
+    """
+
+    def __init__(self, model: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self._trial_in_flight:
+                raise CircuitOpenError(self.model, max(retry_in, 0))
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_in_flight or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    # A fatal error says nothing about the model's health, but a half-open trial has still finished
+    def record_fatal(self):
+        with self._lock:
+            self._trial_in_flight = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(model: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if model not in _breakers:
+            _breakers[model] = CircuitBreaker(model)
+        return _breakers[model]
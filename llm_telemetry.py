@@ -0,0 +1,144 @@
+"""
+Per-call LLM telemetry, collected per run.
+
+Inside `with telemetry_run() as run:` every chat completion the run makes is recorded:
+its stage, wall time, time to first token, prompt/completion/cached tokens and retries.
+run.summary() then shows which stage the run spent its time in.
+
+A run follows its calls onto worker threads only when the work is submitted through
+bind_context, since threads don't inherit the submitting thread's context.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional
+
+from llm import CallEvent, add_hook, prompt_cache_usage
+
+
+class CallRecord(NamedTuple):
+    stage: str
+    model: str
+    cached: bool
+    started: float
+    elapsed: float
+    ttft: Optional[float]
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+    retries: int
+    failed: bool
+
+
+class RunTelemetry:
+    def __init__(self):
+        self.records: List[CallRecord] = []
+        self._lock = threading.Lock()
+
+    def add(self, record: CallRecord):
+        with self._lock:
+            self.records.append(record)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """
+        One row per stage, slowest first. busy_time is how long at least one call of the stage
+        was in flight, so concurrent calls aren't counted twice; share is that as a fraction
+        of the run's total busy time across all stages.
+        """
+        with self._lock:
+            records = list(self.records)
+        by_stage: Dict[str, List[CallRecord]] = {}
+        for record in records:
+            by_stage.setdefault(record.stage, []).append(record)
+
+        rows = []
+        for stage, stage_records in by_stage.items():
+            ttfts = [r.ttft for r in stage_records if r.ttft is not None and not r.cached]
+            rows.append({
+                "stage": stage,
+                "calls": len(stage_records),
+                "cache_hits": sum(r.cached for r in stage_records),
+                "failed": sum(r.failed for r in stage_records),
+                "busy_time": round(_busy_time(stage_records), 2),
+                "call_time": round(sum(r.elapsed for r in stage_records), 2),
+                "mean_ttft": round(sum(ttfts) / len(ttfts), 2) if ttfts else None,
+                "prompt_tokens": sum(r.prompt_tokens for r in stage_records),
+                "completion_tokens": sum(r.completion_tokens for r in stage_records),
+                "cached_tokens": sum(r.cached_tokens for r in stage_records),
+                "retries": sum(r.retries for r in stage_records),
+            })
+        total = sum(row["busy_time"] for row in rows) or 1
+        for row in rows:
+            row["share"] = round(row["busy_time"] / total, 2)
+        return sorted(rows, key=lambda row: row["busy_time"], reverse=True)
+
+    # One line naming the stage that dominated, for the end of a run
+    def headline(self) -> str:
+        rows = self.summary()
+        if not rows:
+            return "No LLM calls were made."
+        top = rows[0]
+        return (f"{len(self.records)} LLM calls; {top['stage']} dominated with {top['busy_time']}s "
+                f"({top['share']:.0%} of LLM time) across {top['calls']} calls.")
+
+
+# Length of the union of the records' [started, started + elapsed] intervals
+def _busy_time(records: List[CallRecord]) -> float:
+    busy = 0.0
+    current_start = current_end = None
+    for record in sorted(records, key=lambda r: r.started):
+        end = record.started + record.elapsed
+        if current_end is None or record.started > current_end:
+            if current_end is not None:
+                busy += current_end - current_start
+            current_start, current_end = record.started, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        busy += current_end - current_start
+    return busy
+
+
+_current_run: contextvars.ContextVar[Optional[RunTelemetry]] = contextvars.ContextVar("llm_telemetry_run", default=None)
+
+
+@contextmanager
+def telemetry_run() -> Iterator[RunTelemetry]:
+    run = RunTelemetry()
+    token = _current_run.set(run)
+    try:
+        yield run
+    finally:
+        _current_run.reset(token)
+
+
+def bind_context(fn: Callable) -> Callable:
+    """fn, run in a copy of the caller's context: submit this to an executor to keep the run."""
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+
+def _record(event: CallEvent):
+    run = _current_run.get()
+    if run is None:
+        return
+    usage = event.response.usage if event.response is not None else None
+    prompt_tokens, cached_tokens = prompt_cache_usage(event.response) if event.response is not None else (0, 0)
+    run.add(CallRecord(
+        stage=event.stage or "untagged",
+        model=event.request.get("model", ""),
+        cached=event.cached,
+        started=time.perf_counter() - event.elapsed,
+        elapsed=event.elapsed,
+        ttft=event.ttft,
+        # A cache hit didn't use any tokens this time
+        prompt_tokens=0 if event.cached else prompt_tokens,
+        completion_tokens=0 if event.cached or usage is None else usage.completion_tokens or 0,
+        cached_tokens=0 if event.cached else cached_tokens,
+        retries=event.retries,
+        failed=event.error is not None,
+    ))
+
+
+add_hook(_record)
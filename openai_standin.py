@@ -0,0 +1,426 @@
+"""
+Local stand-in for the OpenAI API, for exercising the LLM layer offline.
+
+Serves chat completions, streamed or not, and the Batch API: file upload and
+download, and batch create and retrieve. Every answer is a synthetic completion
+that looks like the app's real traffic: fewshot-format generations for layout
+prompts, fit_to_spec tool calls for the parse, rewritten text for fixes. Submitted
+batches stay in_progress for --batch-duration seconds, then complete. Point the
+app at it with
+
+    OPENAI_BASE_URL=http://127.0.0.1:8766/v1 OPENAI_API_KEY=x streamlit run Home.py
+
+or let LLM_TRANSPORT=synthetic start one in-process (see llm_cassette).
+
+Usage:
+    python openai_standin.py serve [--latency 0.5] [--token-rate 50] [--noncompliant 0.25] [--batch-duration 5]
+    OPENAI_BASE_URL=http://127.0.0.1:8766/v1 OPENAI_API_KEY=x \
+        python openai_standin.py batch     # submit a small batch to a running stand-in and wait for it
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+
+# A layout's limits, read with the same patterns add_specs uses
+_HYPHEN_LIMITS = re.compile(r'\b(\d{1,2})-(\d{1,2})\b')
+_SLASH_LIMITS = re.compile(r'\((\d+(?:/\d+)*)\)')
+# A "Key: value" line of the fewshot format
+_KEY_LINE = re.compile(r'^([A-Za-z][A-Za-z0-9 ]{0,39}):[ \t]*(.*)$')
+_WORDS = ["new", "team", "bold", "ideas", "today", "growth", "future", "welcome", "together", "launch",
+          "success", "focus", "smart", "forward", "vision", "build", "win", "grow", "office", "culture"]
+# A word too long for any line, for values that should break their limits
+_LONG_WORD = "extraordinarily"
+
+
+def _line_limits(description: str) -> List[Tuple[int, int]]:
+    """(lower, upper) character limits of every line a layout key's description asks for."""
+    if (match := _HYPHEN_LIMITS.search(description)) is not None:
+        return [(int(match.group(1)), int(match.group(2)))]
+    if (match := _SLASH_LIMITS.search(description)) is not None:
+        return [(1, int(n)) for n in match.group(1).split("/")]
+    return [(10, 40)]
+
+
+# Words that fill a line to between lower and upper characters, where they fit
+def _fill_line(rng: random.Random, lower: int, upper: int) -> str:
+    line = ""
+    while len(line) < lower:
+        fitting = [w for w in _WORDS if len(line) + bool(line) + len(w) <= upper]
+        if not fitting:
+            break
+        line = f"{line} {rng.choice(fitting)}".strip()
+    return line or rng.choice(_WORDS)[:upper]
+
+
+def _parse_limits(limits: str) -> List[Tuple[int, int]]:
+    """Undo describe_spec: "2 lines; line 1 at most 12 characters; ..." back into line limits."""
+    match = re.match(r"(\d+) line", limits)
+    lines = int(match.group(1)) if match else 1
+    bounds = [(1, 40)] * lines
+    for i, lower, upper in re.findall(r"line (\d+) between (\d+) and (\d+) characters", limits):
+        bounds[int(i) - 1] = (int(lower), int(upper))
+    for i, upper in re.findall(r"line (\d+) at most (\d+) characters", limits):
+        bounds[int(i) - 1] = (1, int(upper))
+    return bounds
+
+
+# A generation in the fewshot format: every key of the layout, grouped, once per variation.
+# noncompliant is the share of values that break their limits, so the fix stage has work to do.
+def _generation_text(rng: random.Random, prompt: str, noncompliant: float) -> Optional[str]:
+    layout = re.search(r"\*\*Details for Layout [^\n]*\*\*\n(.*?)(?:\n\s*\n|\n-{3,}|$)", prompt, re.S)
+    if layout is None:
+        return None
+    keys = [(m.group(1), m.group(2)) for m in map(_KEY_LINE.match, layout.group(1).splitlines()) if m]
+    variations = int(m.group(1)) if (m := re.search(r"make (\d+) full variations", prompt)) else 3
+    groups = []
+    for key, description in keys:
+        values = []
+        for _ in range(variations):
+            lines = [_fill_line(rng, lower, upper) for lower, upper in _line_limits(description)]
+            if rng.random() < noncompliant:
+                lines[0] = f"{lines[0]} {_LONG_WORD}"
+            values.append(f"{key}: " + "\n".join(lines))
+        groups.append("\n".join(values))
+    return "\n\n".join(groups)
+
+
+# A fix_problems prompt answered the way its reason code asks, on the number of lines it asks for
+def _fix_text(rng: random.Random, prompt: str) -> Optional[str]:
+    lines = re.search(r"on (\d+) lines\.?\s*$", prompt)
+    if lines is None or "---------" not in prompt:
+        return None
+    problem, text = prompt.split("---------", 1)
+    text = text.rsplit("\n\nPlease return your new text", 1)[0]
+    words = text.split() or [rng.choice(_WORDS)]
+    if "only 2 words" in problem:
+        words = sorted(words, key=len)[:2]
+    elif problem.startswith("Add 1 word"):
+        words.append(rng.choice([w for w in _WORDS if len(w) <= 5]))
+    count = int(lines.group(1))
+    per_line = max(1, -(-len(words) // count))
+    out = [" ".join(words[i:i + per_line]) for i in range(0, len(words), per_line)][:count]
+    out += [rng.choice(_WORDS) for _ in range(count - len(out))]
+    return "\n".join(out)
+
+
+# "Key: value" pairs of a fewshot-format text, values running on until the next key line
+def _parse_pairs(text: str) -> List[Dict[str, str]]:
+    pairs = []
+    for line in text.splitlines():
+        match = _KEY_LINE.match(line)
+        if match:
+            pairs.append({"key": match.group(1).strip(), "value": match.group(2).rstrip()})
+        elif pairs and line.strip():
+            pairs[-1]["value"] = f"{pairs[-1]['value']}\n{line.rstrip()}".lstrip("\n")
+    return pairs
+
+
+# The rewritten items of a send_batched_fix_to_openai prompt, each within its limits
+def _batched_fixes(rng: random.Random, prompt: str) -> List[Dict[str, Any]]:
+    fixes = []
+    for item in re.finditer(r"key: (.*)\nindex: (\d+)\nproblem: .*\nlimits: (.*)\ntext:", prompt):
+        lines = [_fill_line(rng, lower, upper) for lower, upper in _parse_limits(item.group(3))]
+        fixes.append({"key": item.group(1), "index": int(item.group(2)), "new_value": "\n".join(lines)})
+    return fixes
+
+
+# An instance of a JSON schema, for tools and response formats. Strings whose description
+# gives line limits the way describe_spec writes them ("2 lines; line 1 at most 12 characters")
+# are written within them, noncompliant of the time not; other strings are placeholders.
+# Arrays get items_count items.
+def _instance(schema: Dict[str, Any], rng: random.Random, items_count: int = 1, noncompliant: float = 0.0,
+              name: str = "") -> Any:
+    if "enum" in schema:
+        return schema["enum"][0]
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: _instance(value, rng, items_count, noncompliant, key) for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_instance(schema.get("items", {}), rng, items_count, noncompliant, name) for _ in range(items_count)]
+    if kind in ("integer", "number"):
+        return 1
+    if kind == "boolean":
+        return True
+    limits = re.search(r"\d+ lines?\b.*", schema.get("description", ""))
+    if limits is None:
+        return f"Stand-in {name}".strip()
+    lines = [_fill_line(rng, lower, upper) for lower, upper in _parse_limits(limits.group(0))]
+    if rng.random() < noncompliant:
+        lines[0] = f"{lines[0]} {_LONG_WORD}"
+    return "\n".join(lines)
+
+
+# The chat completion the stand-in answers a request body with. It's seeded from the request,
+# so the same request always gets the same answer:
+#   - fit_to_spec tools: one tool call per "Key: value" pair of the text
+#   - extract_pairs: every "Key: value" pair of the text in one tool call
+#   - fix_values: every item rewritten within its limits
+#   - other tools and json_schema response formats: an instance of the schema, one array item
+#     per variation the prompt asks for
+#   - generation prompts: fewshot-format text for the layout's keys
+#   - fix prompts: the text rewritten on the lines asked for
+def synthetic_completion(body: Dict[str, Any], noncompliant: float = 0.0) -> Dict[str, Any]:
+    messages = body.get("messages", [])
+    prompt = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    rng = random.Random(hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest())
+    message: Dict[str, Any] = {"role": "assistant", "content": None}
+
+    tools = {tool["function"]["name"]: tool["function"] for tool in body.get("tools") or []}
+    if tools:
+        choice = body.get("tool_choice")
+        name = choice["function"]["name"] if isinstance(choice, dict) else next(iter(tools))
+        if name == "fit_to_spec":
+            calls = [("fit_to_spec", pair) for pair in _parse_pairs(prompt)]
+        elif name == "extract_pairs":
+            calls = [("extract_pairs", {"pairs": _parse_pairs(prompt)})]
+        elif name == "fix_values":
+            calls = [("fix_values", {"fixes": _batched_fixes(rng, prompt)})]
+        else:
+            calls = [(name, _instance(tools[name].get("parameters", {}), rng))]
+        message["tool_calls"] = [
+            {"id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+             "function": {"name": call_name, "arguments": json.dumps(arguments)}}
+            for call_name, arguments in calls
+        ]
+    elif (body.get("response_format") or {}).get("type") == "json_schema":
+        variations = int(m.group(1)) if (m := re.search(r"make (\d+) full variations", prompt)) else 1
+        message["content"] = json.dumps(_instance(body["response_format"]["json_schema"].get("schema", {}), rng,
+                                                  variations, noncompliant))
+    else:
+        message["content"] = (_generation_text(rng, prompt, noncompliant) or _fix_text(rng, prompt)
+                              or f"Stand-in response to: {prompt.strip().splitlines()[0][:80] if prompt.strip() else ''}")
+
+    output = message["content"] or json.dumps(message.get("tool_calls"))
+    prompt_tokens = len(json.dumps(messages)) // 4
+    completion_tokens = max(1, len(output) // 4)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "standin"),
+        "choices": [{"index": 0, "finish_reason": "tool_calls" if tools else "stop", "message": message}],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+# The chunks a streamed request gets for a completion: the text a few characters at a time
+# (tool calls in one piece), then the finish reason, then usage if stream_options asked for it
+def _completion_chunks(completion: Dict[str, Any], include_usage: bool) -> List[Dict[str, Any]]:
+    choice = completion["choices"][0]
+    base = {key: completion[key] for key in ("id", "created", "model")}
+    base["object"] = "chat.completion.chunk"
+    content = choice["message"]["content"] or ""
+    deltas = [{"role": "assistant", "content": content[i:i + 4]} for i in range(0, len(content), 4)]
+    if choice["message"].get("tool_calls"):
+        deltas.append({"role": "assistant", "tool_calls": [
+            {**call, "index": i} for i, call in enumerate(choice["message"]["tool_calls"])]})
+    chunks = [{**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]} for delta in deltas]
+    chunks.append({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": choice["finish_reason"]}]})
+    if include_usage:
+        chunks.append({**base, "choices": [], "usage": completion["usage"]})
+    return chunks
+
+
+class StandinConfig:
+    def __init__(self, latency: float = 0.0, batch_duration: float = 5.0, token_rate: float = 0.0,
+                 noncompliant: float = 0.0):
+        # Seconds added to every response
+        self.latency = latency
+        # Seconds a submitted batch stays in_progress before it completes
+        self.batch_duration = batch_duration
+        # Completion tokens per second a chat completion is written at (0: all at once)
+        self.token_rate = token_rate
+        # Share of generated layout values that break their limits
+        self.noncompliant = noncompliant
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    config: StandinConfig = StandinConfig()
+    # Reentrant: batches complete (and add their output file) while the lock is held
+    _lock = threading.RLock()
+    _files: Dict[str, Dict[str, Any]] = {}
+    _batches: Dict[str, Dict[str, Any]] = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: Dict[str, Any]):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    # Server-sent events, one per chunk, paced at the configured token rate
+    def _send_stream(self, chunks: List[Dict[str, Any]]):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for chunk in chunks:
+            if self.config.token_rate and chunk["choices"]:
+                time.sleep(1 / self.config.token_rate)
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def _send_bytes(self, content: bytes):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _not_found(self):
+        self._send_json(404, {"error": {"message": f"No such resource: {self.path}", "type": "invalid_request_error"}})
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    @classmethod
+    def _add_file(cls, filename: str, purpose: str, content: bytes) -> Dict[str, Any]:
+        file = {"id": f"file-{uuid.uuid4().hex[:24]}", "object": "file", "bytes": len(content),
+                "created_at": int(time.time()), "filename": filename, "purpose": purpose, "status": "processed"}
+        with cls._lock:
+            cls._files[file["id"]] = {**file, "content": content}
+        return file
+
+    @classmethod
+    def _advance(cls, batch: Dict[str, Any]):
+        # Batches complete lazily, the first time they're looked at after batch_duration
+        if batch["status"] != "in_progress" or time.time() - batch["in_progress_at"] < cls.config.batch_duration:
+            return
+        lines = cls._files[batch["input_file_id"]]["content"].decode().splitlines()
+        output = []
+        for line in filter(None, (line.strip() for line in lines)):
+            item = json.loads(line)
+            output.append(json.dumps({
+                "id": f"batch_req_{uuid.uuid4().hex[:12]}",
+                "custom_id": item["custom_id"],
+                "response": {"status_code": 200, "request_id": uuid.uuid4().hex, "body": synthetic_completion(item["body"], cls.config.noncompliant)},
+                "error": None,
+            }))
+        output_file = cls._add_file(f"{batch['id']}_output.jsonl", "batch_output", ("\n".join(output) + "\n").encode())
+        now = int(time.time())
+        batch.update({"status": "completed", "output_file_id": output_file["id"], "finalizing_at": now,
+                      "completed_at": now, "request_counts": {"total": len(output), "completed": len(output), "failed": 0}})
+
+    def do_POST(self):
+        if self.config.latency:
+            time.sleep(self.config.latency)
+
+        if self.path == "/v1/chat/completions":
+            body = json.loads(self._body())
+            completion = synthetic_completion(body, self.config.noncompliant)
+            if body.get("stream"):
+                include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+                return self._send_stream(_completion_chunks(completion, include_usage))
+            if self.config.token_rate:
+                time.sleep(completion["usage"]["completion_tokens"] / self.config.token_rate)
+            return self._send_json(200, completion)
+
+        if self.path == "/v1/files":
+            # multipart/form-data with a purpose field and the file itself
+            message = BytesParser(policy=default_policy).parsebytes(
+                b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + self._body())
+            fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+            file_part = fields["file"]
+            return self._send_json(200, self._add_file(file_part.get_filename() or "upload.jsonl",
+                                                       fields["purpose"].get_content().strip(),
+                                                       file_part.get_payload(decode=True)))
+
+        if self.path == "/v1/batches":
+            body = json.loads(self._body())
+            if body.get("input_file_id") not in self._files:
+                return self._send_json(400, {"error": {"message": "Unknown input_file_id", "type": "invalid_request_error"}})
+            now = int(time.time())
+            total = sum(1 for line in self._files[body["input_file_id"]]["content"].splitlines() if line.strip())
+            batch = {
+                "id": f"batch_{uuid.uuid4().hex[:24]}", "object": "batch", "endpoint": body["endpoint"],
+                "input_file_id": body["input_file_id"], "completion_window": body["completion_window"],
+                "status": "in_progress", "created_at": now, "in_progress_at": now, "expires_at": now + 24 * 3600,
+                "output_file_id": None, "error_file_id": None, "metadata": body.get("metadata"),
+                "request_counts": {"total": total, "completed": 0, "failed": 0},
+            }
+            with self._lock:
+                self._batches[batch["id"]] = batch
+            return self._send_json(200, batch)
+
+        self._not_found()
+
+    def do_GET(self):
+        if self.config.latency:
+            time.sleep(self.config.latency)
+        parts = self.path.strip("/").split("/")
+
+        if len(parts) == 3 and parts[:2] == ["v1", "batches"]:
+            with self._lock:
+                batch = self._batches.get(parts[2])
+                if batch is None:
+                    return self._not_found()
+                self._advance(batch)
+                return self._send_json(200, batch)
+
+        if len(parts) == 4 and parts[:2] == ["v1", "files"] and parts[3] == "content":
+            file = self._files.get(parts[2])
+            if file is None:
+                return self._not_found()
+            return self._send_bytes(file["content"])
+
+        self._not_found()
+
+
+def serve(config: StandinConfig, host: str = "127.0.0.1", port: int = 8766) -> ThreadingHTTPServer:
+    """Start the stand-in on a background thread and return the server (call shutdown() to stop)."""
+    StandinHandler.config = config
+    server = ThreadingHTTPServer((host, port), StandinHandler)
+    threading.Thread(target=server.serve_forever, name="openai-standin", daemon=True).start()
+    return server
+
+
+# Submit a few requests as a batch, wait for it and print what came back
+def batch(poll_interval: float = 1):
+    from llm_batch import batch_results, submit_batch, wait_for_batch, write_batch_file
+
+    requests_by_id = {f"Layout {i}": {"model": "gpt-4-turbo", "messages": [{"role": "user", "content": f"Write layout {i}"}]}
+                      for i in range(1, 4)}
+    started = time.perf_counter()
+    submitted = submit_batch(write_batch_file(requests_by_id))
+    done = wait_for_batch(submitted.id, poll_interval, on_poll=lambda b: print(f"{b.id}: {b.status}"))
+    for custom_id, response in batch_results(done).items():
+        print(f"{custom_id}: {response.choices[0].message.content if response else None}")
+    print(f"Batch finished in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI API")
+    parser.add_argument("command", choices=["serve", "batch"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--batch-duration", type=float, default=5.0)
+    parser.add_argument("--token-rate", type=float, default=0.0)
+    parser.add_argument("--noncompliant", type=float, default=0.0)
+    args = parser.parse_args()
+
+    if args.command == "batch":
+        batch()
+    else:
+        server = serve(StandinConfig(args.latency, args.batch_duration, args.token_rate, args.noncompliant), args.host, args.port)
+        print(f"OpenAI stand-in on http://{args.host}:{args.port}/v1")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            server.shutdown()
@@ -0,0 +1,55 @@
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+# Shared by every session; page loads only need a handful of fetches each
+_prefetch_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="page-prefetch")
+
+
+def prefetch(dependencies: Dict[str, Optional[Callable[[], Any]]]) -> Dict[str, Future]:
+    """
+    Start every data dependency of a page at once on a thread pool.
+
+    Returns a future per name, so time to first render is the slowest single fetch
+    rather than the sum of them. Entries whose loader is None are skipped, which
+    lets a page list dependencies that only apply in some states.
+    """
+    ctx = get_script_run_ctx()
+
+    def run(loader):
+        # Attach the page's script context so st.error calls in the helpers still render
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return loader()
+
+    return {name: _prefetch_pool.submit(run, loader) for name, loader in dependencies.items() if loader is not None}
+
+
+class PageData:
+    """
+    The Airtable datasets a page declares it may use.
+
+    A dataset is fetched on first access (page_data["tones"]) and never if the page
+    doesn't touch it. prefetch(*names) starts several at once, for the datasets the
+    page knows it's about to need.
+    """
+
+    def __init__(self, **loaders: Callable[[], Any]):
+        self._loaders = loaders
+        self._futures: Dict[str, Future] = {}
+
+    def prefetch(self, *names: str) -> "PageData":
+        pending = {name: self._loaders[name] for name in names if name not in self._futures}
+        self._futures.update(prefetch(pending))
+        return self
+
+    def __getitem__(self, name: str) -> Any:
+        if name not in self._futures:
+            future = Future()
+            try:
+                future.set_result(self._loaders[name]())
+            except Exception as e:
+                future.set_exception(e)
+            self._futures[name] = future
+        return self._futures[name].result()
@@ -1,20 +1,28 @@
 import streamlit as st
 import json
+import logging
 import pandas as pd
 import requests
 from st_copy_to_clipboard import st_copy_to_clipboard
 
 from io import BytesIO
 from PIL import Image
+from airtable import invalidate_airtable_cache
+from page_data import PageData
 from helpers import get_content_types_data, get_table_data, process_table_data, get_selected_layouts_array, generate_prompts_array_with_variations, send_to_openai
 from helpers import add_specs, evaluate_character_count_and_lines, extract_key_value_pairs, send_to_openai_with_tools, tools
 from helpers import send_plaintext_to_openai, get_client_data, prepare_layout_selector_data, assemble_prompt, get_image_from_url
 from helpers import group_values, fix_problems, update_grouped, evaluate_character_count_and_lines_of_group
+from helpers import run_layout_chain, stream_to_openai, build_content_messages, LAYOUT_CONCURRENCY, FIX_MODE, PARSE_MODE, GENERATION_MODE
+from llm_telemetry import telemetry_run, bind_context
 from dummy import dummy_prompt
 import openai
 from typing import List, Dict, Union, Any, Tuple
+import threading
 import webbrowser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from streamlit.components.v1 import html
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 def open_page(url):
     open_script = """
@@ -30,11 +38,22 @@ st.set_page_config(layout="wide")
 # Streamlit UI - Title
 st.title("Content Creation AI")
 
+# Drop the shared Airtable cache so the next read pulls fresh data
+if st.sidebar.button("Refresh from Airtable"):
+    invalidate_airtable_cache()
+
 # Display all the prompts from Content Types
 topic = st.text_area("Prompt", height=100)
 
+# The Airtable datasets this page uses. Each is fetched on first access, never if unused.
+page_data = PageData(
+    content_types=get_content_types_data,
+    tones=lambda: get_table_data('Tone'),
+    layouts=lambda: get_table_data(st.session_state["content_type"]),
+)
+
 # Retrieve data from Airtable
-content_types_data = get_content_types_data()
+content_types_data = page_data["content_types"]
 
 # Extract and filter content types where v1 is true
 v1_true_content_types = [item["Content Type"] for item in content_types_data if item["v1"]]
@@ -43,17 +62,16 @@ v1_true_content_types = [item["Content Type"] for item in content_types_data if
 options = ["Select a Content Type"] + v1_true_content_types
 
 # Add a selectbox to the Streamlit app
-selected_content_type = st.selectbox("Choose a Content Type", options)
-
-# Retrieve client data from Airtable
-client_data = get_client_data()
+selected_content_type = st.selectbox("Choose a Content Type", options, key="content_type")
 
 if selected_content_type != "Select a Content Type":
     # Filter data to get the selected content type details
     selected_data = next((item for item in content_types_data if item["Content Type"] == selected_content_type), None)
 
     if selected_data:
-        
+        # Tones are needed from here on, and layouts too if there's an image prompt: fetch them together
+        page_data.prefetch("tones", *(["layouts"] if selected_data.get("Image Prompt") else []))
+
         # Show an example prompt for the selected content type
         example_value = selected_data["Example Prompt"]
         st.write(f"Example Prompts: {example_value}")
@@ -65,8 +83,19 @@ if selected_content_type != "Select a Content Type":
         # Add "Group By" selectbox
         group_by = st.selectbox("Group By", options=["Layout", "Key"])
 
+        # How many layouts the image subloop generates at once (1 runs them one after another)
+        layout_concurrency = st.sidebar.number_input("Layouts Generated at Once", 1, 10, value=LAYOUT_CONCURRENCY)
+        # Fix each failing value with its own request, or all of an iteration's values in one call
+        fix_mode = st.sidebar.selectbox("Fix Mode", options=["parallel", "batched"], index=["parallel", "batched"].index(FIX_MODE))
+        # Split generations into key/value pairs locally where the format allows, or always with OpenAI
+        parse_mode = st.sidebar.selectbox("Parse Mode", options=["local", "llm"], index=["local", "llm"].index(PARSE_MODE))
+        # Free text that's parsed afterwards, or values by key held to a schema built from the layout
+        generation_mode = st.sidebar.selectbox("Generation Mode", options=["text", "structured"], index=["text", "structured"].index(GENERATION_MODE))
+        # Answer requests identical to earlier ones from the response cache; untick to regenerate
+        use_cache = st.sidebar.checkbox("Reuse Cached Responses", value=True)
+
         # Fetch Tone table data from Airtable
-        tone_data = get_table_data('Tone')
+        tone_data = page_data["tones"]
         
         # Extract 'Tone' and 'Tone Description' columns
         tone_list = [record['fields']['Tone'] for record in tone_data if 'Tone' in record['fields']]
@@ -83,7 +112,7 @@ if selected_content_type != "Select a Content Type":
 
         if selected_data.get("Image Prompt"):
             # Load data from the table corresponding to the selected content type
-            table_data = get_table_data(selected_content_type)
+            table_data = page_data["layouts"]
 
             # Process the table data into a DataFrame
             df = process_table_data(table_data)
@@ -175,160 +204,126 @@ if selected_content_type != "Select a Content Type":
                 content_casual = selected_data.get("Content Casual")
                 content_direct = selected_data.get("Content Direct")
                 
-                # Start generating
-                all_results = ""  # Initialize a single string to hold all results
-                # Variation loop I took out
-                results = []  # Initialize a list to hold the results
+                # Record every LLM call of this generation, to show which stage took the time
+                with telemetry_run() as telemetry:
+                    # Start generating
+                    all_results = ""  # Initialize a single string to hold all results
+                    # Variation loop I took out
+                    results = []  # Initialize a list to hold the results
     
-                # This starts the IMAGE SUBLOOP. Images are complicated because they have stringent character length requirements. 
-                # Only FAQ images are exempt - they are actually too complex to map here.
-                if image_prompt:
-
-                    st.subheader("Image Results: Text for Selected Layout")
-                    # Generate prompts array for image_prompt
-                    prompts_array = generate_prompts_array_with_variations(topic, image_prompt, layouts_array, variations)
-                    #st.write("Prompts array", prompts_array)
-                
-                    # Go to OpenAI for each one
-                    for prompt, layout in zip(prompts_array, layouts_array):
-                        layout_key = list(layout.keys())[0]  # Extract the layout key (e.g., "Layout 1")
-                
-                        # Check if content type is 'FAQ'
-                        if selected_content_type == "FAQ":
-                            # Generate response and add directly to results
-                            messages = prompt['message']
-                            response = send_to_openai(messages)
-                            all_results += f"Generated Response for {layout_key}:\n{response}\n\n"
-                            st.text(all_results)
-                            continue  # Skip rest of the iteration
-                        
-                        for retry in range(3):  # Retry up to 3 times
-                            # st.subheader(f"Images - Generated Response for {layout_key}")
-                            messages = prompt['message']
-                            specs = prompt['specs']
-                            response = send_to_openai(messages)
-                            #st.write("OpenAI response", response)
-                            if not response:
-                                # st.write(f"Failed to get a response. Retrying {retry + 1}/3...")
-                                continue  # Retry without incrementing n
-                
-                            tool_call_prompt = "Please extract relevant entities (Title, Subtitle and any others) from the below text." + "\n\n---------------\n\n" + response
-                            layout_messages = [{"role": "user", "content": response}]
-                            layout_response = send_to_openai_with_tools(layout_messages)
-                            pairs_json = extract_key_value_pairs(layout_response)
-                            #st.write("Pairs JSON initial", pairs_json)
-                
-                            iterations = 0
-                            missing_key = False  # Flag to indicate missing key
-                            max_retries = 3
-                            grouped = group_values(pairs_json)
-                            #st.write("Grouped", grouped)
-                            #st.write("Specs", specs)
-                            
-                            while iterations < 5:
-                                # Evaluate the grouped values based on specifications
-                                evaluation = evaluate_character_count_and_lines_of_group(grouped, specs)
-                                #st.write("Evaluation", evaluation)
-                
-                                # Break if all criteria are met and no reason_code is present in the evaluation
-                                if not any("reason_code" in value for item in evaluation for value in item['values'].values()):
-                                    #st.info(f"Completed in {iterations} iterations.")
-                                    break  # Break the fixing loop since all criteria are met
-                
-                                # Check for missing key issue
-                                if any("reason_code" in value and "The specified key is missing" in value["reason_code"] for item in evaluation for value in item['values'].values()):
-                                    missing_key = True
-                                    break  # Break the fixing loop to retry with a new generation
-                
-                                # Fix identified problems systematically
-                                problems, keys_to_fix, indices_to_fix, line_counts = fix_problems(evaluation)
-                                #st.subheader("Fix Problems")
-                                for problem, key, index, line_count in zip(problems, keys_to_fix, indices_to_fix, line_counts):
-                                    #st.write(f"Fixing problem for {key} at index {index}: {problem}")
-                                    prompt_with_context = f"{problem}\n\nPlease return your new text, on {line_count} lines."
-                                    # Send request to OpenAI for generating fix
-                                    fixed_response = send_plaintext_to_openai(prompt_with_context)
-                                    #st.write(f"Fixed response for {key} at index {index}: {fixed_response}")
-                
-                                    # Update the grouped structure with fixed_response
-                                    updated = update_grouped(grouped, key, index, fixed_response)
-                                    #st.write("Updated", updated)
-                                    #st.write("Updated Grouped", grouped)
-                
-                                    if not updated:
-                                        st.write(f"Could not update value for {key} at index {index} with content {fixed_response}")
-                
-                                iterations += 1
-                
-                            if missing_key:
-                                st.write(f"Missing key detected. Retrying {retry + 1}/{max_retries}...")
-                            else:
-                                break
-                
-                            if retry == max_retries - 1:  # If we've exhausted retries
-                                st.write("Max retries exhausted. Moving on to the next layout.")
-                            
-                            #st.write("Final grouped", grouped)
-                
-                        # Collect and format the final output
-                        result = f"Generated Response for {layout_key}:\n"
+                    # This starts the IMAGE SUBLOOP. Images are complicated because they have stringent character length requirements. 
+                    # Only FAQ images are exempt - they are actually too complex to map here.
+                    if image_prompt:
+
+                        st.subheader("Image Results: Text for Selected Layout")
+                        # Generate prompts array for image_prompt
+                        prompts_array = generate_prompts_array_with_variations(topic, image_prompt, layouts_array, variations)
+                        #st.write("Prompts array", prompts_array)
                 
-                        # Iterate over each group and format the key-value pairs correctly
-                        if group_by == "Key":
-                            # Grouping by Key, keep current logic
-                            result = ""
-                            for group in grouped:
-                                key = group['key']
-                                values = group['values']
-                                for index, value in values.items():
-                                    result += f"{key} {index}: {value}\n"
-                                result += "-" * 30 + "\n"
-                            results.append(result)
-                        
-                        elif group_by == "Layout":
-                            # Grouping by Layout, new logic
-                            indices = set()
-                            for group in grouped:
-                                indices.update(group['values'].keys())
-                            
+                        # Format one layout's final values for display and download
+                        def format_layout_result(grouped):
                             result = ""
-                            for index in sorted(indices):
+                            if group_by == "Key":
+                                # Grouping by Key, keep current logic
                                 for group in grouped:
                                     key = group['key']
-                                    value = group['values'].get(index, "")  # Use .get() to avoid KeyError
-                                    result += f"{key} {index}: {value}\n"
-                                result += "-" * 30 + "\n"
-                            results.append(result)
-                    
-                    # Append all accumulated results to the main results string
-                    for result in results:
-                        all_results += result
-                        st.text(all_results)
+                                    values = group['values']
+                                    for index, value in values.items():
+                                        result += f"{key} {index}: {value}\n"
+                                    result += "-" * 30 + "\n"
+                            elif group_by == "Layout":
+                                # Grouping by Layout, new logic
+                                indices = set()
+                                for group in grouped:
+                                    indices.update(group['values'].keys())
+                                for index in sorted(indices):
+                                    for group in grouped:
+                                        key = group['key']
+                                        value = group['values'].get(index, "")  # Use .get() to avoid KeyError
+                                        result += f"{key} {index}: {value}\n"
+                                    result += "-" * 30 + "\n"
+                            return result
+
+                        # Stream an FAQ layout's response into its placeholder from a worker thread
+                        script_run_ctx = get_script_run_ctx()
+                        def stream_into(placeholder, messages):
+                            add_script_run_ctx(threading.current_thread(), script_run_ctx)
+                            text = ""
+                            for delta in stream_to_openai(messages, use_cache):
+                                text += delta
+                                placeholder.text(text)
+                            return text or None
+
+                        # Go to OpenAI for every layout at once, up to layout_concurrency at a time,
+                        # and show each layout as soon as its generate -> parse -> fix chain finishes
+                        with ThreadPoolExecutor(max_workers=layout_concurrency) as executor:
+                            futures = {}
+                            for prompt, layout in zip(prompts_array, layouts_array):
+                                layout_key = list(layout.keys())[0]  # Extract the layout key (e.g., "Layout 1")
+                                # FAQ layouts are too complex to map, so they skip the parse and fix stages
+                                # and stream straight into a placeholder, in layout order
+                                if selected_content_type == "FAQ":
+                                    st.caption(layout_key)
+                                    futures[executor.submit(bind_context(stream_into), st.empty(), prompt['message'])] = layout_key
+                                else:
+                                    futures[executor.submit(bind_context(run_layout_chain), prompt, fix_mode=fix_mode, use_cache=use_cache, parse_mode=parse_mode, generation_mode=generation_mode)] = layout_key
+
+                            finished = {}
+                            for future in as_completed(futures):
+                                layout_key = futures[future]
+                                try:
+                                    outcome = future.result()
+                                except Exception as e:
+                                    # One layout failing shouldn't lose the ones that already finished
+                                    logging.exception(f"Layout {layout_key} failed")
+                                    st.caption(layout_key)
+                                    st.write(f"Could not generate {layout_key}: {e}. Moving on to the next layout.")
+                                    finished[layout_key] = ""
+                                    continue
+                                if selected_content_type == "FAQ":
+                                    # Already on screen from the stream
+                                    finished[layout_key] = f"Generated Response for {layout_key}:\n{outcome}\n\n"
+                                    continue
+                                st.caption(layout_key)
+                                grouped, notes = outcome
+                                for note in notes:
+                                    st.write(note)
+                                result = format_layout_result(grouped)
+                                st.text(result)
+                                finished[layout_key] = result
+
+                        # Keep the download in layout order, whatever order the layouts finished in
+                        for layout_key in futures.values():
+                            results.append(finished[layout_key])
+                        all_results += "".join(results)
     
-                    # ------ The above is the end of the IMAGE SUBLOOP.
+                        # ------ The above is the end of the IMAGE SUBLOOP.
     
-                    # Now we do the CONTENT SUBLOOP. We work through other prompts (content_professional, content_casual, content_direct) and apply different logic.
-                    other_prompts = [
-                        ("Content Professional", content_professional),
-                        ("Content Casual", content_casual),
-                        ("Content Direct", content_direct)
-                    ]
+                        # Now we do the CONTENT SUBLOOP. We work through other prompts (content_professional, content_casual, content_direct) and apply different logic.
+                        other_prompts = [
+                            ("Content Professional", content_professional),
+                            ("Content Casual", content_casual),
+                            ("Content Direct", content_direct)
+                        ]
     
-                    for prompt_name, prompt_content in other_prompts:
-                        if prompt_content:
-                            st.subheader(f"Generated Results for {prompt_name}")
-                            other_prompt_messages = []
-                            other_prompt = company_tone_style + "\n\n--------------\n\n" + topic + "\n\n-----------\n\n" + prompt_content + "\n\nPlease create " + str(variations) + "different variations."
-                            other_prompt_messages.append({"role": "user", "content": other_prompt})
-                            response = send_to_openai(other_prompt_messages)
-                            st.write(response)
-                            all_results += f"Generated Response for {prompt_name}:\n{response}\n\n"
+                        for prompt_name, prompt_content in other_prompts:
+                            if prompt_content:
+                                st.subheader(f"Generated Results for {prompt_name}")
+                                other_prompt_messages = build_content_messages(company_tone_style, prompt_content, topic, variations)
+                                # Render the variations as they arrive; write_stream returns the full text
+                                # (or an empty list if the request failed before any text came back)
+                                response = st.write_stream(stream_to_openai(other_prompt_messages, use_cache, stage="content")) or None
+                                all_results += f"Generated Response for {prompt_name}:\n{response}\n\n"
     
-                # Display a JSON object for debugging
-                #st.subheader("Debug")
-                #st.write(prompts_array)
+                    # Display a JSON object for debugging
+                    #st.subheader("Debug")
+                    #st.write(prompts_array)
     
-                # This ends the CONTENT SUBLOOP.
+                    # This ends the CONTENT SUBLOOP.
+
+                st.caption(telemetry.headline())
+                with st.expander("LLM Timing by Stage"):
+                    st.dataframe(pd.DataFrame(telemetry.summary()), hide_index=True)
     
                 # Button to download the results as RTF
                 if st.download_button("Download Results as RTF", all_results, file_name="results.rtf", mime="application/rtf"):
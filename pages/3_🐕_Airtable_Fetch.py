@@ -1,39 +1,20 @@
 import streamlit as st
-import requests
+from airtable import get_airtable_client
+from airtable_schema import get_schema_registry
 
-# Function to get field names and IDs from the "Content Types" table
+# Function to get field names and IDs from the "Content Types" table, via the schema registry
 def get_field_names_and_ids():
     base_id = 'appbJ9Bt0YNuBafT4'
-    table_id = 'Content Types'  # This could be the table name or ID
-    airtable_token = st.secrets.AIRTABLE_PERSONAL_TOKEN
-    headers = {
-        "Authorization": f"Bearer {airtable_token}"
-    }
-
-    url = f"https://api.airtable.com/v0/meta/bases/{base_id}/tables"
-    response = requests.get(url, headers=headers)
-
-    if response.status_code != 200:
-        st.error(f"Failed to retrieve table metadata: {response.text}")
-        return []
-
-    tables = response.json().get('tables', [])
-
-    table_fields = {}
-    for table in tables:
-        if table['name'] == table_id or table['id'] == table_id:
-            table_fields = table['fields']
-            break
-
-    field_ids = {}
-    for field in table_fields:
-        field_ids[field['name']] = field['id']
-
-    return field_ids
+    table_name = 'Content Types'
+    return get_schema_registry().fields(base_id, table_name)
 
 # Streamlit UI
 st.title("Airtable Content Types Field IDs Fetcher")
 
+# Re-read table and field metadata for every base and persist it
+if st.button("Refresh schema from Airtable"):
+    get_schema_registry().refresh()
+
 field_ids = get_field_names_and_ids()
 
 if field_ids:
@@ -42,3 +23,7 @@ if field_ids:
         st.write(f"Name: {name}, ID: {id_}")
 else:
     st.write("No fields found.")
+
+# Airtable client counters for this process
+st.subheader("Airtable Client Stats")
+st.json(get_airtable_client().stats())
@@ -6,6 +6,8 @@ import logging
 
 from io import BytesIO
 from PIL import Image
+from airtable import invalidate_airtable_cache
+from page_data import PageData
 from helpers import (
     get_content_types_data,
     get_table_data,
@@ -24,7 +26,14 @@ from helpers import (
     fix_problems,
     update_grouped,
     evaluate_character_count_and_lines_of_group,
+    run_layout_chain,
+    generation_request,
+    build_content_messages,
+    PARSE_MODE,
+    GENERATION_MODE,
 )
+from llm_telemetry import telemetry_run
+from llm_batch import FINAL_STATUSES, batch_results, retrieve_batch, submit_batch, wait_for_batch, write_batch_file
 import openai
 
 # Set up logging
@@ -36,9 +45,31 @@ st.set_page_config(layout="wide")
 # Title
 st.title("Automated Testing for Content Creation AI")
 
+# Drop the shared Airtable cache so the next read pulls fresh data
+if st.sidebar.button("Refresh from Airtable"):
+    invalidate_airtable_cache()
+
+# Off by default: a test run should sample fresh generations, not replay the last run's
+use_cache = st.sidebar.checkbox("Reuse Cached Responses", value=False)
+# Send the first-pass generations as one Batch API job: slower to come back, but cheaper and
+# higher throughput for big sweeps, and the page can be closed while it runs
+batch_mode = st.sidebar.checkbox("Batch API Mode", value=False)
+# Split generations into key/value pairs locally where the format allows, or always with OpenAI
+parse_mode = st.sidebar.selectbox("Parse Mode", options=["local", "llm"], index=["local", "llm"].index(PARSE_MODE))
+# Free text that's parsed afterwards, or values by key held to a schema built from the layout
+generation_mode = st.sidebar.selectbox("Generation Mode", options=["text", "structured"], index=["text", "structured"].index(GENERATION_MODE))
+
+# The Airtable datasets this page uses. Each is fetched on first access, never if unused;
+# content types and clients are both needed straight away, so they're fetched together.
+page_data = PageData(
+    content_types=get_content_types_data,
+    clients=get_client_data,
+    layouts=lambda: get_table_data(st.session_state["content_type"]),
+).prefetch("content_types", "clients")
+
 # Retrieve data from Airtable for content types and clients
-content_types_data = get_content_types_data()
-client_data = get_client_data()
+content_types_data = page_data["content_types"]
+client_data = page_data["clients"]
 
 # Extract and filter content types where v1 is true
 v1_true_content_types = [item["Content Type"] for item in content_types_data if item["v1"]]
@@ -53,7 +84,7 @@ if "Global App Testing" in company_name_list:
 
 # Manual input for testing parameters
 selected_company_name = st.selectbox("Company", options=["Select a Company"] + company_name_list, index=default_company_index)
-selected_content_type = st.selectbox("Content Type", options=content_type_options)
+selected_content_type = st.selectbox("Content Type", options=content_type_options, key="content_type")
 variations = st.number_input("Number of Variations", 1, 10, value=10, step=1)
 topic = st.text_area("Prompt", height=100)
 
@@ -66,6 +97,48 @@ def get_image_from_url(url):
     response = requests.get(url)
     return Image.open(BytesIO(response.content))
 
+# Submit every first-pass generation as one batch, or pick up an earlier batch by its ID.
+# Returns the response text by custom ID once the batch has completed, and None until then.
+# Text and structured generations can't stand in for each other, so each generation mode
+# keeps its own batch ID, and a batch from the other mode is refused.
+def batch_first_responses(requests_by_id):
+    session_key = f"autotest_batch_id_{generation_mode}"
+    batch_id = st.text_input("Batch ID", value=st.session_state.get(session_key, ""),
+                             help="Submit a new batch, or paste the ID of an earlier one to pick up its results")
+    if st.button("Submit Batch"):
+        path = write_batch_file(requests_by_id)
+        metadata = {"content_type": selected_content_type, "generation_mode": generation_mode}
+        st.session_state[session_key] = submit_batch(path, metadata=metadata).id
+        st.rerun()
+    if not batch_id:
+        st.write("Submit a batch to start the test.")
+        return None
+
+    batch = retrieve_batch(batch_id)
+    # Batches from before generation modes were all text
+    batch_mode_used = (batch.metadata or {}).get("generation_mode", "text")
+    if batch_mode_used != generation_mode:
+        st.error(f"Batch {batch.id} was submitted in {batch_mode_used} generation mode. "
+                 f"Switch Generation Mode to {batch_mode_used}, or submit a new batch.")
+        return None
+
+    status = st.empty()
+    status.write(f"Batch {batch.id}: {batch.status} ({batch.request_counts.completed}/{batch.request_counts.total} requests done)"
+                 if batch.request_counts else f"Batch {batch.id}: {batch.status}")
+    if batch.status not in FINAL_STATUSES:
+        st.button("Check Batch Status")
+        if not st.button("Wait for Batch"):
+            return None
+        batch = wait_for_batch(batch_id, on_poll=lambda b: status.write(f"Batch {b.id}: {b.status}"))
+    if batch.status != "completed":
+        st.error(f"Batch {batch.id} is {batch.status}. Submit a new one.")
+        return None
+
+    return {
+        custom_id: response.choices[0].message.content if response else None
+        for custom_id, response in batch_results(batch).items()
+    }
+
 if selected_content_type != "Select a Content Type":
     selected_data = next((item for item in content_types_data if item["Content Type"] == selected_content_type), None)
 
@@ -79,7 +152,7 @@ if selected_content_type != "Select a Content Type":
 
         if image_prompt:
             # Load data corresponding to the selected content type
-            table_data = get_table_data(selected_content_type)
+            table_data = page_data["layouts"]
             df = process_table_data(table_data)
             orient_json = df.to_json(orient="records")
             edited_json = json.loads(orient_json)
@@ -99,89 +172,65 @@ if selected_content_type != "Select a Content Type":
             layouts_string = ", ".join(layout_numbers)
             layouts_array = get_selected_layouts_array(edited_json_with_specs, layouts_string)
 
-            # Automate testing
-            all_results = ""
-            for idx, layout in enumerate(layouts_array):
-                layout_key = list(layout.keys())[0]
-                logging.info(f"Processing layout {layout_key} ({idx + 1}/{len(layouts_array)})")
-                prompts_array = generate_prompts_array_with_variations(topic, image_prompt, [layout], variations)
-                
-                for prompt in prompts_array:
-                    for retry in range(3):
-                        messages = prompt["message"]
-                        specs = prompt["specs"]
-                        response = send_to_openai(messages)
-                        
-                        if not response:
-                            logging.warning(f"No response from OpenAI for layout {layout_key}. Retrying {retry + 1}/3...")
-                            continue
-
-                        tool_call_prompt = "Please extract relevant entities (Title, Subtitle and any others) from the below text.\n\n---------------\n\n" + response
-                        layout_messages = [{"role": "user", "content": response}]
-                        layout_response = send_to_openai_with_tools(layout_messages)
-                        pairs_json = extract_key_value_pairs(layout_response)
-
-                        iterations = 0
-                        missing_key = False
-                        max_retries = 3
-                        grouped = group_values(pairs_json)
-
-                        while iterations < 5:
-                            evaluation = evaluate_character_count_and_lines_of_group(grouped, specs)
-                            if not any("reason_code" in value for item in evaluation for value in item["values"].values()):
-                                break
-
-                            if any("reason_code" in value and "The specified key is missing" in value["reason_code"] for item in evaluation for value in item["values"].values()):
-                                missing_key = True
-                                break
-
-                            problems, keys_to_fix, indices_to_fix, line_counts = fix_problems(evaluation)
-                            for problem, key, index, line_count in zip(problems, keys_to_fix, indices_to_fix, line_counts):
-                                prompt_with_context = f"{problem}\n\nPlease return your new text, on {line_count} lines."
-                                fixed_response = send_plaintext_to_openai(prompt_with_context)
-                                updated = update_grouped(grouped, key, index, fixed_response)
-                                if not updated:
-                                    logging.error(f"Could not update value for {key} at index {index} with content {fixed_response}")
-                                    continue
-
-                            iterations += 1
-
-                        if missing_key:
-                            logging.error(f"Missing key detected for layout {layout_key}. Retrying {retry + 1}/{max_retries}...")
-                            continue
-                        else:
-                            break
-
-                        if retry == max_retries - 1:
-                            logging.error(f"Max retries exhausted for layout {layout_key}. Moving on to the next layout.")
-                            continue
-
-                    result = f"Generated Response for {layout_key}:\n"
-                    for group in grouped:
-                        key = group["key"]
-                        values = group["values"]
-                        for index, value in values.items():
-                            result += f"{key} {index}: {value}\n"
-                    result += "-" * 30 + "\n"
-                    all_results += result
-
-            # Content loop
+            # Every first-pass generation of the test: one per layout, then the content prompts
+            prompts_by_layout = {
+                list(layout.keys())[0]: prompt
+                for layout, prompt in zip(layouts_array, generate_prompts_array_with_variations(topic, image_prompt, layouts_array, variations))
+            }
             other_prompts = [
                 ("Content Professional", content_professional),
                 ("Content Casual", content_casual),
                 ("Content Direct", content_direct),
             ]
+            content_messages = {
+                prompt_name: build_content_messages(company_tone_style, prompt_content, topic, variations)
+                for prompt_name, prompt_content in other_prompts if prompt_content
+            }
 
-            for prompt_name, prompt_content in other_prompts:
-                if prompt_content:
-                    other_prompt_messages = []
-                    other_prompt = company_tone_style + "\n\n--------------\n\n" + topic + "\n\n-----------\n\n" + prompt_content + "\n\nPlease create " + str(variations) + " different variations."
-                    other_prompt_messages.append({"role": "user", "content": other_prompt})
-                    response = send_to_openai(other_prompt_messages)
-                    all_results += f"Generated Response for {prompt_name}:\n{response}\n\n"
-
-            if st.download_button("Download Results as RTF", all_results, file_name="results.rtf", mime="application/rtf"):
-                st.write("Download initiated.")
+            # In Batch API mode the first-pass generations come from a batch, and the test waits for it
+            first_responses = {}
+            if batch_mode:
+                # Structured mode batches the schema-constrained requests run_layout_chain would send
+                first_responses = batch_first_responses({
+                    **{layout_key: generation_request(prompt["message"], prompt["schema"] if generation_mode == "structured" else None)
+                       for layout_key, prompt in prompts_by_layout.items()},
+                    **{prompt_name: generation_request(messages) for prompt_name, messages in content_messages.items()},
+                })
+
+            if first_responses is not None:
+                # Record every LLM call of the test, to show which stage took the time
+                with telemetry_run() as telemetry:
+                    # Automate testing
+                    all_results = ""
+                    for idx, (layout_key, prompt) in enumerate(prompts_by_layout.items()):
+                        logging.info(f"Processing layout {layout_key} ({idx + 1}/{len(prompts_by_layout)})")
+                        grouped, notes = run_layout_chain(prompt, use_cache=use_cache, first_response=first_responses.get(layout_key), parse_mode=parse_mode, generation_mode=generation_mode)
+                        for note in notes:
+                            logging.warning(f"{layout_key}: {note}")
+
+                        result = f"Generated Response for {layout_key}:\n"
+                        for group in grouped:
+                            key = group["key"]
+                            values = group["values"]
+                            for index, value in values.items():
+                                result += f"{key} {index}: {value}\n"
+                        result += "-" * 30 + "\n"
+                        all_results += result
+
+                    # Content loop
+                    for prompt_name, messages in content_messages.items():
+                        response = first_responses.get(prompt_name) or send_to_openai(messages, use_cache, stage="content")
+                        all_results += f"Generated Response for {prompt_name}:\n{response}\n\n"
+
+                summary = telemetry.summary()
+                logging.info(telemetry.headline())
+                for row in summary:
+                    logging.info(f"LLM stage {row['stage']}: {row}")
+                st.caption(telemetry.headline())
+                st.dataframe(pd.DataFrame(summary), hide_index=True)
+
+                if st.download_button("Download Results as RTF", all_results, file_name="results.rtf", mime="application/rtf"):
+                    st.write("Download initiated.")
 
     else:
         st.write("No details available for the selected content type.")
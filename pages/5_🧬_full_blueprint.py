@@ -4,11 +4,14 @@ import io
 import numpy as np
 import json
 import openai
+from llm import chat_completion, model_for
+from llm_telemetry import telemetry_run
 import csv
 import re
 import requests
 from collections import OrderedDict
-from helpers import process_content_table, create_filter_json, get_filter_options, get_unique_content_kits, query_airtable_table
+from airtable import invalidate_airtable_cache
+from helpers import process_content_table, create_filter_json, get_filter_options, get_unique_content_kits, query_airtable_table, compile_content_filter_formula
 
 tools = [
     {
@@ -89,9 +92,11 @@ content_kit_tools = [
     }
 ]
 
-def call_openai(messages):
-    response_raw = openai.chat.completions.create(
-        model="gpt-4o-2024-08-06",
+def call_openai(messages, use_cache=True, stage=None):
+    response_raw = chat_completion(
+        use_cache=use_cache,
+        stage=stage,
+        model=model_for("structured"),
         messages=messages
     )
     return response_raw.choices[0].message.content
@@ -103,9 +108,11 @@ def get_content_kit_names(base_id, content_kits_records):
     else:
         return "Failed to fetch Content Kit names"
 
-def call_openai_with_tools(messages, tools):
-    response_raw = openai.chat.completions.create(
-        model="gpt-4o-2024-08-06",
+def call_openai_with_tools(messages, tools, use_cache=True, stage=None):
+    response_raw = chat_completion(
+        use_cache=use_cache,
+        stage=stage,
+        model=model_for("structured"),
         messages=messages,
         tools=tools,
         tool_choice="required"
@@ -114,14 +121,14 @@ def call_openai_with_tools(messages, tools):
     json_str = tool_call.function.arguments
     return json_str
 
-def process_prompts(pcc_plaintext):
+def process_prompts(pcc_plaintext, use_cache=True):
     messages = []
 
     st.write("Running prompt 1 - Steps")
     # Process prompt 1
     full_prompt_1 = prompt_1_intro_boilerplate + user_prompt + prompt_1_outro_boilerplate
     messages.append({"role": "user", "content": full_prompt_1})
-    response_1 = call_openai_with_tools(messages, tools)
+    response_1 = call_openai_with_tools(messages, tools, use_cache, stage="blueprint stage 1")
     messages.append({"role": "assistant", "content": response_1})
     st.json(response_1)
 
@@ -129,7 +136,7 @@ def process_prompts(pcc_plaintext):
     # Process prompt 2
     full_prompt_2 = prompt_2_boilerplate + pcc_plaintext + "As a reminder, the JSON object with the step numbers and descriptions is:" + '\n\n' + str(response_1)
     messages.append({"role": "user", "content": full_prompt_2})
-    response_2 = call_openai_with_tools(messages, tools)
+    response_2 = call_openai_with_tools(messages, tools, use_cache, stage="blueprint stage 2")
     messages.append({"role": "assistant", "content": response_2})
     st.json(response_2)
 
@@ -137,7 +144,7 @@ def process_prompts(pcc_plaintext):
     # Process prompt 2a
     full_prompt_2a = prompt_2a_boilerplate + pcc_plaintext + "As a reminder, the JSON object with the step numbers and descriptions is:" + '\n\n' + str(response_2)
     messages.append({"role": "user", "content": full_prompt_2a})
-    response_2a = call_openai_with_tools(messages, tools)
+    response_2a = call_openai_with_tools(messages, tools, use_cache, stage="blueprint stage 2a")
     messages.append({"role": "assistant", "content": response_2a})
     st.json(response_2a)
 
@@ -145,7 +152,7 @@ def process_prompts(pcc_plaintext):
     # Process prompt 3
     full_prompt_3 = prompt_3_boilerplate + '\n\n' + "As a reminder, the JSON object with steps and elements we're adding to is:" + '\n\n' + str(response_2a)
     messages.append({"role": "user", "content": full_prompt_3})
-    response_3 = call_openai_with_tools(messages, tools)
+    response_3 = call_openai_with_tools(messages, tools, use_cache, stage="blueprint stage 3")
     messages.append({"role": "assistant", "content": response_3})
     st.json(response_3)
 
@@ -157,6 +164,13 @@ base_id = "appkUZW01q89QDGB9"
 # Streamlit UI
 st.title("Blueprint Builder")
 
+# Drop the shared Airtable cache so the next read pulls fresh data
+if st.sidebar.button("Refresh from Airtable"):
+    invalidate_airtable_cache()
+
+# Answer requests identical to earlier ones from the response cache; untick to regenerate
+use_cache = st.sidebar.checkbox("Reuse Cached Responses", value=True)
+
 user_prompt = st.text_area("What kind of blueprint do you want to make?", value="New Hire Onboarding", height=100)
 
 prompt_1_intro_boilerplate = """Create program/initiative blueprints for an HR/People employee initiative. The theme of this initiative is: """
@@ -210,25 +224,31 @@ You will need to write your own Description. It should be longer than the others
 Return the new Educational Elements first within each step, ahead of the other stuff you composed in prior steps."""
 
 if st.button("Process"):
-    # Fetch Content Kit data from Airtable
-    st.write("Fetching Content Kit names from Airtable to use as examples")
-    content_kits_records = query_airtable_table(base_id, "Content Kits")
-    names = get_content_kit_names(base_id, content_kits_records)
-    matching_prompt = """Here is a list of Content Kits we've created. Each of them contains outlines for an HR initiative:\n\n""" + names + """\n\nPlease return the 5 of these which most closely match this initiative submitted by a user:\n\n""" + user_prompt + """\n\nReturn no more than 5. Don't return any filters."""
-    matching_messages = []
-    matching_messages.append({"role": "user", "content": matching_prompt})
-    matching_response = call_openai_with_tools(matching_messages, content_kit_tools)
-    st.write("Found matching Content Kits from Airtable")
-    st.json(matching_response)
-
-    # Fetch the matches from Airtable
-    st.write("Pulling the full matching content kits from Airtable to use as examples")
-    content_records = query_airtable_table(base_id, "content")
-    filter_json = json.loads(matching_response)
-    processed_data = process_content_table(content_records, content_kits_records, filter_json)
-    pcc_plaintext = str(processed_data)
+    # Record every LLM call of the blueprint, to show which stage took the time
+    with telemetry_run() as telemetry:
+        # Fetch Content Kit data from Airtable
+        st.write("Fetching Content Kit names from Airtable to use as examples")
+        content_kits_records = query_airtable_table(base_id, "Content Kits")
+        names = get_content_kit_names(base_id, content_kits_records)
+        matching_prompt = """Here is a list of Content Kits we've created. Each of them contains outlines for an HR initiative:\n\n""" + names + """\n\nPlease return the 5 of these which most closely match this initiative submitted by a user:\n\n""" + user_prompt + """\n\nReturn no more than 5. Don't return any filters."""
+        matching_messages = []
+        matching_messages.append({"role": "user", "content": matching_prompt})
+        matching_response = call_openai_with_tools(matching_messages, content_kit_tools, use_cache, stage="blueprint kit matching")
+        st.write("Found matching Content Kits from Airtable")
+        st.json(matching_response)
+
+        # Fetch the matches from Airtable
+        st.write("Pulling the full matching content kits from Airtable to use as examples")
+        filter_json = json.loads(matching_response)
+        content_records = query_airtable_table(base_id, "content", compile_content_filter_formula(filter_json, base_id))
+        processed_data = process_content_table(content_records, content_kits_records, filter_json)
+        pcc_plaintext = str(processed_data)
     
-    if 'pcc_plaintext' in locals():
-        process_prompts(pcc_plaintext)
-    else:
-        st.error("Please run the Airtable data retrieval first to generate pcc_plaintext.")
+        if 'pcc_plaintext' in locals():
+            process_prompts(pcc_plaintext, use_cache)
+        else:
+            st.error("Please run the Airtable data retrieval first to generate pcc_plaintext.")
+
+    st.caption(telemetry.headline())
+    with st.expander("LLM Timing by Stage"):
+        st.dataframe(pd.DataFrame(telemetry.summary()), hide_index=True)
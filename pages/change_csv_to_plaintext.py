@@ -4,24 +4,26 @@ import io
 import numpy as np
 import json
 import openai
+from llm import chat_completion, model_for
 import csv
 import re
 from collections import OrderedDict
 
-def call_openai(messages):
-    response_raw = openai.chat.completions.create(
-        model="gpt-4o",
+def call_openai(messages, use_cache=True):
+    response_raw = chat_completion(
+        use_cache=use_cache,
+        model=model_for("convert"),
         messages=messages
     )
     return response_raw.choices[0].message.content
 
-def process_prompts():
+def process_prompts(use_cache=True):
     messages = []
 
     st.write("Running prompt 1 - Steps")
     # Process prompt 1
     messages.append({"role": "user", "content": prompt_1_editable})
-    response_1 = call_openai(messages)
+    response_1 = call_openai(messages, use_cache)
     messages.append({"role": "assistant", "content": response_1})
     #st.write("First Response")
     #st.write(response_1)
@@ -29,14 +31,14 @@ def process_prompts():
     st.write("Running prompt 1 - Communications")
     # Process prompt 1 Comms
     messages.append({"role": "user", "content": prompt_1_comms_editable})
-    response_1_comms = call_openai(messages)
+    response_1_comms = call_openai(messages, use_cache)
     messages.append({"role": "assistant", "content": response_1_comms})
     #st.write("Comms Response")
     #st.write(response_1_comms)
 
     st.write("Running prompt 1 - Designs")
     messages.append({"role": "user", "content": prompt_1a_editable})
-    response_1a = call_openai(messages)
+    response_1a = call_openai(messages, use_cache)
     messages.append({"role": "assistant", "content": response_1a})
     #st.write("Designs Response")
     #st.write(response_1a)
@@ -44,14 +46,14 @@ def process_prompts():
     st.write("Running prompt 2")
     # Process prompt 2
     messages.append({"role": "user", "content": prompt_2_editable})
-    response_2 = call_openai(messages)
+    response_2 = call_openai(messages, use_cache)
     messages.append({"role": "assistant", "content": response_2})
     #st.write(response_2)
     
     st.write("Running prompt 3")
     # Process prompt 3
     messages.append({"role": "user", "content": prompt_3_editable})
-    response_3 = call_openai(messages)
+    response_3 = call_openai(messages, use_cache)
     messages.append({"role": "assistant", "content": response_3})
     #st.write(response_3)
     
@@ -238,6 +240,8 @@ full_prompt_3 = """Wonderful. Now please output the full list as a JSON object w
 
 Don't nest anything - just return a JSON object with each entity containing each of those headers."""
 
+use_cache = st.sidebar.checkbox("Reuse Cached Responses", value=True)
+
 uploaded_file = st.file_uploader("Choose a CSV file", type="csv")
 
 if uploaded_file is not None:
@@ -267,4 +271,4 @@ if uploaded_file is not None:
     prompt_3_editable = st.text_area("Prompt 3 (Editable)", value=full_prompt_3, height=200)
 
     if st.button("Process"):
-        process_prompts()
+        process_prompts(use_cache)
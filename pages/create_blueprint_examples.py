@@ -3,7 +3,8 @@ import requests
 from collections import defaultdict
 import json
 import openai
-from helpers import process_content_table, create_filter_json, get_filter_options, get_unique_content_kits, query_airtable_table
+from llm import chat_completion, model_for
+from helpers import process_content_table, create_filter_json, get_filter_options, get_unique_content_kits, query_airtable_table, compile_content_filter_formula
 
 # Initialize session state
 if 'openai_response' not in st.session_state:
@@ -34,9 +35,10 @@ tools = [
     }
 ]
 
-def call_openai_with_tools(messages, tools):
-    response_raw = openai.chat.completions.create(
-        model="gpt-4o-2024-08-06",
+def call_openai_with_tools(messages, tools, use_cache=True):
+    response_raw = chat_completion(
+        use_cache=use_cache,
+        model=model_for("structured"),
         messages=messages,
         tools=tools
     )
@@ -60,6 +62,7 @@ base_id = "appkUZW01q89QDGB9"
 content_kits_records = query_airtable_table(base_id, "Content Kits")
 names = get_content_kit_names(base_id, content_kits_records)
 user_input = st.text_input("What blueprint do you want to make?")
+use_cache = st.sidebar.checkbox("Reuse Cached Responses", value=True)
 
 if st.button("Run Prompt"):
 
@@ -67,14 +70,14 @@ if st.button("Run Prompt"):
     prompt = st.text_area(label="Prompt", value=prompt_template, height=200)
     messages = []
     messages.append({"role": "user", "content": prompt})
-    response = call_openai_with_tools(messages, tools)
+    response = call_openai_with_tools(messages, tools, use_cache)
     st.json(response)
     st.session_state.openai_response = response
     
 if st.session_state.openai_response:
-    content_records = query_airtable_table(base_id, "content")
     try:
         filter_json = json.loads(st.session_state.openai_response)
+        content_records = query_airtable_table(base_id, "content", compile_content_filter_formula(filter_json, base_id))
         processed_data = process_content_table(content_records, content_kits_records, filter_json)
         st.json(processed_data)
     except json.JSONDecodeError:
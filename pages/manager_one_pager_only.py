@@ -12,6 +12,7 @@ from helpers import send_plaintext_to_openai, get_client_data, prepare_layout_se
 from helpers import group_values, fix_problems, update_grouped, evaluate_character_count_and_lines_of_group
 from dummy import dummy_prompt
 import openai
+from llm import LLM_ERRORS, chat_completion, model_for
 from typing import List, Dict, Union, Any, Tuple
 import webbrowser
 from streamlit.components.v1 import html
@@ -43,25 +44,14 @@ description: a description between 500-608 characters"""
 # Streamlit UI
 st.title("Manager One-Pager JSON")
 prompt = st.text_area("Prompt", value=prompt_default_value, height=400)
+use_cache = st.sidebar.checkbox("Reuse Cached Responses", value=True)
 
 if st.button("Submit"):
         messages = [{"role": "user", "content": prompt}]
         
-        # Your OpenAI API key
-        api_key = st.secrets.OPENAI_API_KEY
-        
-        # The API endpoint
-        url = "https://api.openai.com/v1/chat/completions"
-        
-        # The headers for the request
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
         # The request payload
         payload = {
-            "model": "gpt-4o-2024-08-06",  # Use an available model
+            "model": model_for("structured"),
             "messages": [
                 {
                     "role": "system",
@@ -122,21 +112,16 @@ if st.button("Submit"):
         }
         
         # Make the API call
-        response = requests.post(url, headers=headers, json=payload)
-        
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Parse the JSON response
-            result = response.json()
-            
+        try:
+            response = chat_completion(use_cache=use_cache, **payload)
+        except LLM_ERRORS as e:
+            st.write(f"Error: {e}")
+        else:
             # Extract the generated content
-            generated_content = result['choices'][0]['message']['tool_calls'][0]['function']['arguments']
+            generated_content = response.choices[0].message.tool_calls[0].function.arguments
             
             # Parse the JSON string into a Python dictionary
             contractor_onboarding = json.loads(generated_content)
             
             #st.write(json.dumps(contractor_onboarding, indent=2))
             st.write(contractor_onboarding)
-        else:
-            st.write(f"Error: {response.status_code}")
-            st.write(response.text)
@@ -4,11 +4,12 @@ import io
 import numpy as np
 import json
 import openai
+from llm import chat_completion, model_for
 import csv
 import re
 import requests
 from collections import OrderedDict
-from helpers import process_content_table, create_filter_json, get_filter_options, get_unique_content_kits, query_airtable_table
+from helpers import process_content_table, create_filter_json, get_filter_options, get_unique_content_kits, query_airtable_table, compile_content_filter_formula
 
 # Set the main JSON schema
 tools = [
@@ -83,9 +84,10 @@ content_kit_tools = [
     }
 ]
 
-def call_openai(messages):
-    response_raw = openai.chat.completions.create(
-        model="gpt-4o-2024-08-06",
+def call_openai(messages, use_cache=True):
+    response_raw = chat_completion(
+        use_cache=use_cache,
+        model=model_for("structured"),
         messages=messages
     )
     return response_raw.choices[0].message.content
@@ -97,9 +99,10 @@ def get_content_kit_names(base_id, content_kits_records):
     else:
         return "Failed to fetch Content Kit names"
 
-def call_openai_with_tools(messages, tools):
-    response_raw = openai.chat.completions.create(
-        model="gpt-4o-2024-08-06",
+def call_openai_with_tools(messages, tools, use_cache=True):
+    response_raw = chat_completion(
+        use_cache=use_cache,
+        model=model_for("structured"),
         messages=messages,
         tools=tools,
         tool_choice="required"
@@ -108,14 +111,14 @@ def call_openai_with_tools(messages, tools):
     json_str = tool_call.function.arguments
     return json_str
 
-def process_prompts(pcc_plaintext):
+def process_prompts(pcc_plaintext, use_cache=True):
     messages = []
 
     st.write("Running prompt 1 - Steps")
     # Process prompt 1
     full_prompt_1 = prompt_1_intro_boilerplate + user_prompt + prompt_1_outro_boilerplate
     messages.append({"role": "user", "content": full_prompt_1})
-    response_1 = call_openai_with_tools(messages, tools)
+    response_1 = call_openai_with_tools(messages, tools, use_cache)
     messages.append({"role": "assistant", "content": response_1})
     st.json(response_1)
 
@@ -123,7 +126,7 @@ def process_prompts(pcc_plaintext):
     # Process prompt 2
     full_prompt_2 = prompt_2_boilerplate + pcc_plaintext + "As a reminder, the JSON object with the step numbers and descriptions is:" + '\n\n' + str(response_1)
     messages.append({"role": "user", "content": full_prompt_2})
-    response_2 = call_openai_with_tools(messages, tools)
+    response_2 = call_openai_with_tools(messages, tools, use_cache)
     messages.append({"role": "assistant", "content": response_2})
     st.json(response_2)
 
@@ -131,7 +134,7 @@ def process_prompts(pcc_plaintext):
     # Process prompt 3
     full_prompt_3 = prompt_3_boilerplate + '\n\n' + "As a reminder, the JSON object with steps and elements we're adding to is:" + '\n\n' + str(response_2)
     messages.append({"role": "user", "content": full_prompt_3})
-    response_3 = call_openai_with_tools(messages, tools)
+    response_3 = call_openai_with_tools(messages, tools, use_cache)
     messages.append({"role": "assistant", "content": response_3})
     st.json(response_3)
 
@@ -184,6 +187,8 @@ For 'content_type' on these, return 'Educational Element.' \n
 You will need to write your own Description. It should be longer than the others, 4 sentences long at least. Keep the description tone friendly like an upbeat advisor that’s giving you specific advice on the topic. Try not to generalize too much and provide specific tips that could be really useful.  \n
 Return the new Educational Elements first within each step, ahead of the other stuff you composed in prior steps."""
 
+use_cache = st.sidebar.checkbox("Reuse Cached Responses", value=True)
+
 if st.button("Process"):
     # Fetch Content Kit data from Airtable
     st.write("Fetching Content Kit names from Airtable to use as examples")
@@ -192,18 +197,18 @@ if st.button("Process"):
     matching_prompt = """Here is a list of Content Kits we've created. Each of them contains outlines for an HR initiative:\n\n""" + names + """\n\nPlease return the 5 of these which most closely match this initiative submitted by a user:\n\n""" + user_prompt + """\n\nReturn no more than 5. Don't return any filters."""
     matching_messages = []
     matching_messages.append({"role": "user", "content": matching_prompt})
-    matching_response = call_openai_with_tools(matching_messages, content_kit_tools)
+    matching_response = call_openai_with_tools(matching_messages, content_kit_tools, use_cache)
     st.write("Found matching Content Kits from Airtable")
     st.json(matching_response)
 
     # Fetch the matches from Airtable
     st.write("Pulling the full matching content kits from Airtable to use as examples")
-    content_records = query_airtable_table(base_id, "content")
     filter_json = json.loads(matching_response)
+    content_records = query_airtable_table(base_id, "content", compile_content_filter_formula(filter_json, base_id))
     processed_data = process_content_table(content_records, content_kits_records, filter_json)
     pcc_plaintext = str(processed_data)
     
     if 'pcc_plaintext' in locals():
-        process_prompts(pcc_plaintext)
+        process_prompts(pcc_plaintext, use_cache)
     else:
         st.error("Please run the Airtable data retrieval first to generate pcc_plaintext.")
@@ -6,10 +6,13 @@ from st_copy_to_clipboard import st_copy_to_clipboard
 
 from io import BytesIO
 from PIL import Image
+from airtable import invalidate_airtable_cache
+from page_data import PageData
 from helpers import get_content_types_data, get_table_data, process_table_data, get_selected_layouts_array, generate_prompts_array_with_variations, send_to_openai
 from helpers import add_specs, evaluate_character_count_and_lines, extract_key_value_pairs, send_to_openai_with_tools, tools
 from helpers import send_plaintext_to_openai, get_client_data, prepare_layout_selector_data, assemble_prompt, get_image_from_url
 from helpers import group_values, fix_problems, update_grouped, evaluate_character_count_and_lines_of_group
+from helpers import run_layout_chain
 from dummy import dummy_prompt
 import openai
 from typing import List, Dict, Union, Any, Tuple
@@ -30,11 +33,25 @@ st.set_page_config(layout="wide")
 # Streamlit UI - Title
 st.title("Content Creation AI")
 
+# Drop the shared Airtable cache so the next read pulls fresh data
+if st.sidebar.button("Refresh from Airtable"):
+    invalidate_airtable_cache()
+
 # Display all the prompts from Content Types
 topic = st.text_area("Prompt", height=100)
 
+# Off to regenerate everything instead of reusing responses cached from an earlier run
+use_cache = st.sidebar.checkbox("Reuse Cached Responses", value=True)
+
+# The Airtable datasets this page uses. Each is fetched on first access, never if unused.
+page_data = PageData(
+    content_types=get_content_types_data,
+    tones=lambda: get_table_data('Tone'),
+    layouts=lambda: get_table_data(st.session_state["content_type"]),
+)
+
 # Retrieve data from Airtable
-content_types_data = get_content_types_data()
+content_types_data = page_data["content_types"]
 
 # Extract and filter content types where v1 is true
 v1_true_content_types = [item["Content Type"] for item in content_types_data if item["v1"]]
@@ -43,17 +60,16 @@ v1_true_content_types = [item["Content Type"] for item in content_types_data if
 options = ["Select a Content Type"] + v1_true_content_types
 
 # Add a selectbox to the Streamlit app
-selected_content_type = st.selectbox("Choose a Content Type", options)
-
-# Retrieve client data from Airtable
-client_data = get_client_data()
+selected_content_type = st.selectbox("Choose a Content Type", options, key="content_type")
 
 if selected_content_type != "Select a Content Type":
     # Filter data to get the selected content type details
     selected_data = next((item for item in content_types_data if item["Content Type"] == selected_content_type), None)
 
     if selected_data:
-        
+        # Tones are needed from here on, and layouts too if there's an image prompt: fetch them together
+        page_data.prefetch("tones", *(["layouts"] if selected_data.get("Image Prompt") else []))
+
         # Show an example prompt for the selected content type
         example_value = selected_data["Example Prompt"]
         st.write(f"Example Prompts: {example_value}")
@@ -66,7 +82,7 @@ if selected_content_type != "Select a Content Type":
         group_by = st.selectbox("Group By", options=["Layout", "Key"])
 
         # Fetch Tone table data from Airtable
-        tone_data = get_table_data('Tone')
+        tone_data = page_data["tones"]
         
         # Extract 'Tone' and 'Tone Description' columns
         tone_list = [record['fields']['Tone'] for record in tone_data if 'Tone' in record['fields']]
@@ -83,7 +99,7 @@ if selected_content_type != "Select a Content Type":
 
         if selected_data.get("Image Prompt"):
             # Load data from the table corresponding to the selected content type
-            table_data = get_table_data(selected_content_type)
+            table_data = page_data["layouts"]
 
             # Process the table data into a DataFrame
             df = process_table_data(table_data)
@@ -201,78 +217,16 @@ if selected_content_type != "Select a Content Type":
                             if selected_content_type == "FAQ":
                                 # Generate response and add directly to results
                                 messages = prompt['message']
-                                response = send_to_openai(messages)
+                                response = send_to_openai(messages, use_cache)
                                 all_results += f"Generated Response for {layout_key}:\n{response}\n\n"
                                 st.text(all_results)
                                 continue  # Skip rest of the iteration
                             
-                            for retry in range(3):  # Retry up to 3 times
-                                # st.subheader(f"Images - Generated Response for {layout_key}")
-                                messages = prompt['message']
-                                specs = prompt['specs']
-                                response = send_to_openai(messages)
-                                #st.write("OpenAI response", response)
-                                if not response:
-                                    # st.write(f"Failed to get a response. Retrying {retry + 1}/3...")
-                                    continue  # Retry without incrementing n
-                    
-                                tool_call_prompt = "Please extract relevant entities (Title, Subtitle and any others) from the below text." + "\n\n---------------\n\n" + response
-                                layout_messages = [{"role": "user", "content": response}]
-                                layout_response = send_to_openai_with_tools(layout_messages)
-                                pairs_json = extract_key_value_pairs(layout_response)
-                                #st.write("Pairs JSON initial", pairs_json)
-                    
-                                iterations = 0
-                                missing_key = False  # Flag to indicate missing key
-                                max_retries = 3
-                                grouped = group_values(pairs_json)
-                                #st.write("Grouped", grouped)
-                                #st.write("Specs", specs)
-                                
-                                while iterations < 5:
-                                    # Evaluate the grouped values based on specifications
-                                    evaluation = evaluate_character_count_and_lines_of_group(grouped, specs)
-                                    #st.write("Evaluation", evaluation)
-                    
-                                    # Break if all criteria are met and no reason_code is present in the evaluation
-                                    if not any("reason_code" in value for item in evaluation for value in item['values'].values()):
-                                        #st.info(f"Completed in {iterations} iterations.")
-                                        break  # Break the fixing loop since all criteria are met
-                    
-                                    # Check for missing key issue
-                                    if any("reason_code" in value and "The specified key is missing" in value["reason_code"] for item in evaluation for value in item['values'].values()):
-                                        missing_key = True
-                                        break  # Break the fixing loop to retry with a new generation
-                    
-                                    # Fix identified problems systematically
-                                    problems, keys_to_fix, indices_to_fix, line_counts = fix_problems(evaluation)
-                                    #st.subheader("Fix Problems")
-                                    for problem, key, index, line_count in zip(problems, keys_to_fix, indices_to_fix, line_counts):
-                                        #st.write(f"Fixing problem for {key} at index {index}: {problem}")
-                                        prompt_with_context = f"{problem}\n\nPlease return your new text, on {line_count} lines."
-                                        # Send request to OpenAI for generating fix
-                                        fixed_response = send_plaintext_to_openai(prompt_with_context)
-                                        #st.write(f"Fixed response for {key} at index {index}: {fixed_response}")
-                    
-                                        # Update the grouped structure with fixed_response
-                                        updated = update_grouped(grouped, key, index, fixed_response)
-                                        #st.write("Updated", updated)
-                                        #st.write("Updated Grouped", grouped)
-                    
-                                        if not updated:
-                                            st.write(f"Could not update value for {key} at index {index} with content {fixed_response}")
-                    
-                                    iterations += 1
-                    
-                                if missing_key:
-                                    st.write(f"Missing key detected. Retrying {retry + 1}/{max_retries}...")
-                                else:
-                                    break
-                    
-                                if retry == max_retries - 1:  # If we've exhausted retries
-                                    st.write("Max retries exhausted. Moving on to the next layout.")
-                                
-                                #st.write("Final grouped", grouped)
+                            # Generate, parse and fix like the Generate page. The LLM layer retries
+                            # with backoff and respects the circuit breaker, so no retries here.
+                            grouped, notes = run_layout_chain(prompt, use_cache=use_cache)
+                            for note in notes:
+                                st.write(note)
                     
                             # Collect and format the final output
                             result = f"Generated Response for {layout_key}:\n"
@@ -324,7 +278,7 @@ if selected_content_type != "Select a Content Type":
                                 other_prompt_messages = []
                                 other_prompt = company_tone_style + "\n\n--------------\n\n" + topic + "\n\n-----------\n\n" + prompt_content + "\n\nPlease create " + str(variations) + "different variations."
                                 other_prompt_messages.append({"role": "user", "content": other_prompt})
-                                response = send_to_openai(other_prompt_messages)
+                                response = send_to_openai(other_prompt_messages, use_cache)
                                 st.write(response)
                                 all_results += f"Generated Response for {prompt_name}:\n{response}\n\n"
         
@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# The app's modules live at the repo root and read their settings from the environment on
+# import, so point their caches and snapshots somewhere disposable before any test imports them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_scratch = tempfile.mkdtemp(prefix="app-tests-")
+os.environ.setdefault("LLM_CACHE_PATH", os.path.join(_scratch, "llm_cache.sqlite3"))
+os.environ.setdefault("LLM_BATCH_DIR", os.path.join(_scratch, "batches"))
+os.environ.setdefault("AIRTABLE_SNAPSHOT_PATH", os.path.join(_scratch, "airtable_snapshot.sqlite3"))
+os.environ.setdefault("AIRTABLE_PERSONAL_TOKEN", "test")
+os.environ.setdefault("AIRTABLE_SECOND_TOKEN", "test")
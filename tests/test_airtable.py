@@ -0,0 +1,121 @@
+import shutil
+import time
+
+import pytest
+
+import airtable
+import airtable_standin
+from airtable_snapshot import SnapshotStore
+
+BASE_ID = "appbJ9Bt0YNuBafT4"
+
+
+@pytest.fixture
+def standin(tmp_path, monkeypatch):
+    """An Airtable stand-in serving a copy of the fixtures, with a fresh cache and snapshot."""
+    fixtures = tmp_path / "fixtures"
+    shutil.copytree(airtable_standin.FIXTURES_DIR, fixtures)
+    config = airtable_standin.StandinConfig(fixtures_dir=str(fixtures))
+    server = airtable_standin.serve(config, port=0)
+    monkeypatch.setattr(airtable, "AIRTABLE_API_URL", f"http://127.0.0.1:{server.server_address[1]}/v0")
+    monkeypatch.setattr(airtable, "_cache", airtable.TTLCache())
+    monkeypatch.setattr(airtable, "_snapshot", SnapshotStore(str(tmp_path / "snapshot.sqlite3")))
+    yield config
+    server.shutdown()
+
+
+def test_slow_sync_serves_snapshot_briefly_then_drops_it(standin, monkeypatch):
+    airtable.list_records(BASE_ID, "Tone")
+    airtable.invalidate_airtable_cache(expire_snapshot=False)
+
+    monkeypatch.setattr(airtable, "SNAPSHOT_SYNC_WAIT", 0.05)
+    standin.latency = 0.3
+    records = airtable.list_records(BASE_ID, "Tone")
+    assert records
+
+    # The stale snapshot is cached for STALE_CACHE_TTL, not the table's hour
+    (expires, _), = airtable._cache._entries.values()
+    assert expires - time.monotonic() <= airtable.STALE_CACHE_TTL
+
+    # and dropped as soon as the background sync finishes
+    deadline = time.monotonic() + 5
+    while len(airtable._cache) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(airtable._cache) == 0
+
+
+def test_reads_during_a_slow_sync_share_it(standin, monkeypatch):
+    airtable.list_records(BASE_ID, "Tone")
+    airtable.invalidate_airtable_cache(expire_snapshot=False)
+
+    syncs = []
+    sync_snapshot = airtable._sync_snapshot
+    monkeypatch.setattr(airtable, "_sync_snapshot", lambda *args: syncs.append(args) or sync_snapshot(*args))
+    monkeypatch.setattr(airtable, "SNAPSHOT_SYNC_WAIT", 0.01)
+    standin.latency = 0.3
+    for _ in range(3):
+        assert airtable.list_records(BASE_ID, "Tone")
+        # The short-lived stale entry expiring while the sync is still running
+        airtable._cache.invalidate()
+    assert len(syncs) == 1
+
+    deadline = time.monotonic() + 5
+    while airtable._syncs and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not airtable._syncs
+
+
+def test_renamed_projected_field_falls_back_to_every_field_on_a_warm_start(standin, tmp_path):
+    params = {"fields[]": ["Layout", "Title"]}
+    assert "Title" in airtable.list_records(BASE_ID, "Poster", params)[0]["fields"]
+
+    # Title is renamed in Airtable, so the projection now gets a 422
+    poster = tmp_path / "fixtures" / BASE_ID / "tables" / "Poster.json"
+    poster.write_text(poster.read_text().replace('"Title"', '"Heading"'))
+    airtable.invalidate_airtable_cache(expire_snapshot=False)
+
+    records = airtable.list_records(BASE_ID, "Poster", params)
+    assert "Heading" in records[0]["fields"]
+
+
+def test_manifest_fetch_falls_back_to_names_when_the_registry_misses_a_field(standin, monkeypatch):
+    import helpers
+
+    class StaleRegistry:
+        # Knows the table, but not a field renamed since it was loaded
+        def field_ids(self, base_id, table_name, field_names):
+            return {"Tone": "fldTone"}
+
+    monkeypatch.setattr(helpers, "get_schema_registry", lambda: StaleRegistry())
+    records = helpers.fetch_manifest_records(BASE_ID, "Tone")
+    assert records and all("Tone Description" in record["fields"] for record in records)
+
+
+def test_rejected_projection_keeps_the_filter(standin, monkeypatch):
+    sent = []
+    get = airtable._client.get
+    monkeypatch.setattr(airtable._client, "get", lambda base_id, url, params, *args: sent.append(dict(params)) or get(base_id, url, params, *args))
+
+    params = {"fields[]": ["Content Title", "Renamed Field"], "filterByFormula": "{Step} != ''"}
+    records = airtable.list_records("appkUZW01q89QDGB9", "content", params, token_secret="AIRTABLE_SECOND_TOKEN")
+    assert records
+    assert sent[-1] == {"filterByFormula": "{Step} != ''"}
+
+
+def test_manifest_fetch_projects_onto_the_alternative_the_table_has(standin, tmp_path, monkeypatch, caplog):
+    import airtable_schema
+    import helpers
+
+    monkeypatch.setattr(airtable_schema, "AIRTABLE_API_URL", airtable.AIRTABLE_API_URL)
+    registry = airtable_schema.SchemaRegistry(str(tmp_path / "schema.json"))
+    monkeypatch.setattr(helpers, "get_schema_registry", lambda: registry)
+    sent = []
+    get = airtable._client.get
+    monkeypatch.setattr(airtable._client, "get", lambda base_id, url, params=None, *args, **kwargs: sent.append(params) or get(base_id, url, params, *args, **kwargs))
+
+    # The content table has a plain Content Type field, not the lookup the manifest prefers
+    records = helpers.fetch_manifest_records("appkUZW01q89QDGB9", "content", token_secret="AIRTABLE_SECOND_TOKEN")
+    assert any("Content Type" in record["fields"] for record in records)
+    assert not caplog.records
+    record_requests = [params for params in sent if params and "fields[]" in params]
+    assert len(record_requests) == 1 and record_requests[0]["returnFieldsByFieldId"] == "true"
@@ -0,0 +1,58 @@
+import openai
+import pytest
+
+import llm
+import llm_cassette
+import openai_standin
+from helpers import run_layout_chain
+from llm_batch import batch_results, submit_batch, wait_for_batch, write_batch_file
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    """An OpenAI stand-in the LLM layer talks to directly, whose values sometimes break their limits."""
+    server = openai_standin.serve(openai_standin.StandinConfig(batch_duration=0, noncompliant=0.25), port=0)
+    monkeypatch.setattr(llm, "_client", openai.OpenAI(
+        base_url=f"http://127.0.0.1:{server.server_address[1]}/v1", api_key="test", max_retries=0))
+    yield server
+    server.shutdown()
+
+
+def _use_cassette(monkeypatch, mode, path):
+    monkeypatch.setattr(llm_cassette, "LLM_TRANSPORT", mode)
+    monkeypatch.setattr(llm_cassette, "LLM_CASSETTE_PATH", str(path))
+    monkeypatch.setattr(llm_cassette, "LLM_REPLAY_LATENCY_SCALE", 0.0)
+    monkeypatch.setattr(llm_cassette, "_cassette", None)
+
+
+def test_replay_reproduces_recorded_layout_chains(standin, tmp_path, monkeypatch):
+    cassette_path = tmp_path / "cassette.jsonl"
+    _, prompts, _ = llm_cassette.fixture_prompts(variations=2)
+
+    _use_cassette(monkeypatch, "record", cassette_path)
+    recorded = [run_layout_chain(prompt, use_cache=False) for prompt in prompts]
+    assert all(grouped for grouped, _ in recorded)
+
+    # Replay with the stand-in gone, so anything missing from the cassette fails rather than going out
+    standin.shutdown()
+    _use_cassette(monkeypatch, "replay", cassette_path)
+    replayed = [run_layout_chain(prompt, use_cache=False) for prompt in prompts]
+    assert replayed == recorded
+
+
+def test_batch_round_trip(standin):
+    requests_by_id = {f"Layout {i}": {"model": "gpt-4-turbo", "messages": [{"role": "user", "content": f"Write layout {i}"}]}
+                      for i in range(1, 4)}
+    submitted = submit_batch(write_batch_file(requests_by_id))
+    done = wait_for_batch(submitted.id, poll_interval=0.01)
+    results = batch_results(done)
+    assert set(results) == set(requests_by_id)
+    assert all(response.choices[0].message.content for response in results.values())
+
+
+def test_replay_miss_is_an_llm_error(tmp_path, monkeypatch):
+    cassette_path = tmp_path / "empty.jsonl"
+    cassette_path.write_text("")
+    _use_cassette(monkeypatch, "replay", cassette_path)
+    with pytest.raises(llm.LLM_ERRORS):
+        llm.chat_completion(use_cache=False, model="gpt-4o", messages=[{"role": "user", "content": "Hi"}])
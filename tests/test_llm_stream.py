@@ -0,0 +1,64 @@
+import openai
+import pytest
+from openai.types.chat import ChatCompletionChunk
+
+import helpers
+import llm
+import llm_retry
+
+
+def _chunk(text):
+    return ChatCompletionChunk.model_validate({
+        "id": "chatcmpl-test", "object": "chat.completion.chunk", "created": 0, "model": "test-model",
+        "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}],
+    })
+
+
+class _Raw:
+    headers = {}
+
+    def __init__(self, chunks, error=None):
+        self._chunks, self._error = chunks, error
+
+    def parse(self):
+        def stream():
+            yield from (_chunk(text) for text in self._chunks)
+            if self._error is not None:
+                raise self._error
+        return stream()
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    monkeypatch.setattr(llm_retry, "backoff_delay", lambda attempt, error=None: 0)
+    monkeypatch.setattr(llm, "backoff_delay", lambda attempt, error=None: 0)
+    breaker = llm_retry.CircuitBreaker("test-model")
+    monkeypatch.setattr(llm, "get_circuit_breaker", lambda model: breaker)
+    return breaker
+
+
+def test_stream_broken_part_way_is_reported_and_marked(monkeypatch, breaker):
+    monkeypatch.setattr(llm, "_create", lambda request, timeout, stream: _Raw(["Hello", " there"], openai.APIConnectionError(request=None)))
+    monkeypatch.setattr(helpers, "model", "test-model")
+
+    text = "".join(helpers.stream_to_openai([{"role": "user", "content": "hi"}], use_cache=False))
+
+    assert text == "Hello there" + helpers.STREAM_INTERRUPTED_MARKER
+    assert breaker.failures == 1
+
+
+def test_stream_broken_before_any_text_is_retried(monkeypatch, breaker):
+    attempts = []
+
+    def create(request, timeout, stream):
+        attempts.append(1)
+        if len(attempts) == 1:
+            return _Raw([], openai.APIConnectionError(request=None))
+        return _Raw(["Fine"])
+
+    monkeypatch.setattr(llm, "_create", create)
+    text = "".join(llm.chat_completion_stream(use_cache=False, model="test-model", messages=[{"role": "user", "content": "hi"}]))
+
+    assert text == "Fine"
+    assert len(attempts) == 2
+    assert breaker.failures == 0
@@ -0,0 +1,69 @@
+import pytest
+
+import helpers
+from helpers import LOCAL_PARSE_MIN_CONFIDENCE, fewshot_prompt, layout_keys, parse_fewshot_pairs
+
+LAYOUT = """**Details for Layout 2**
+Title: 3 lines to put on the zoom background, every line is maximum 10 characters each (10/10/10)
+Hashtag 1: A hashtag of between 15-21 characters
+Hashtag 2: A hashtag of between 15-21 characters
+"""
+KEYS = ["Title", "Hashtag 1", "Hashtag 2"]
+
+# The example response fewshot_prompt itself shows the model
+FEWSHOT_EXAMPLE = fewshot_prompt.split("you'd return something like:\n\n")[1].split("\n\nAs you can see")[0]
+
+
+def test_layout_keys_skips_the_heading():
+    assert layout_keys(LAYOUT) == KEYS
+
+
+def test_fewshot_example_parses_with_full_confidence():
+    pairs, confidence = parse_fewshot_pairs(FEWSHOT_EXAMPLE, KEYS)
+    assert confidence == 1.0
+    assert [pair["key"] for pair in pairs] == ["Title"] * 3 + ["Hashtag 1"] * 3 + ["Hashtag 2"] * 3
+    assert pairs[0]["value"] == "Welcome\nNew CFO\nConnor!"
+    assert pairs[3]["value"] == "#WelcomeToTheTeam"
+
+
+def test_preamble_sign_off_and_markdown_keep_full_confidence():
+    text = "Sure! Here you go:\n\n**Title:** Hi\nthere\nyou\n\nHashtag 1: #a\nHashtag 2: #b\n\nHope that helps!"
+    pairs, confidence = parse_fewshot_pairs(text, KEYS)
+    assert confidence == 1.0
+    assert pairs[0] == {"key": "Title", "value": "Hi\nthere\nyou"}
+
+
+def test_longer_key_wins_over_its_prefix():
+    pairs, _ = parse_fewshot_pairs("Hashtag 10: #x\nHashtag 1: #y", ["Hashtag 1", "Hashtag 10"])
+    assert [pair["key"] for pair in pairs] == ["Hashtag 10", "Hashtag 1"]
+
+
+def test_numbered_keys_fall_below_the_threshold():
+    pairs, confidence = parse_fewshot_pairs("Title 1: Hi\nTitle 2: Yo\nSubtitle 1: Hello", ["Title", "Subtitle"])
+    assert pairs == []
+    assert confidence == 0.0
+
+
+def test_prose_between_values_lowers_confidence():
+    text = "Title: Hi\n\nThis one is playful.\nHashtag 1: #a\nHashtag 2: #b"
+    _, confidence = parse_fewshot_pairs(text, KEYS)
+    assert confidence == pytest.approx(0.75)
+    assert confidence < LOCAL_PARSE_MIN_CONFIDENCE
+
+
+def test_missing_key_and_uneven_variations_lower_confidence():
+    _, missing = parse_fewshot_pairs("Title: Hi\nHashtag 1: #a", KEYS)
+    assert missing == 0.0
+    _, uneven = parse_fewshot_pairs("Title: Hi\nTitle: Yo\nHashtag 1: #a\nHashtag 2: #b", KEYS)
+    assert uneven == pytest.approx(0.5)
+    assert max(missing, uneven) < LOCAL_PARSE_MIN_CONFIDENCE
+
+
+def test_parse_without_an_answer_is_retried_as_unreadable(monkeypatch):
+    monkeypatch.setattr(helpers, "send_to_openai", lambda messages, use_cache=True, schema=None: "Not the fewshot format")
+    monkeypatch.setattr(helpers, "send_to_openai_with_tools", lambda messages, use_cache=True: None)
+    prompt = {"message": [], "specs": {}, "layout": [{"content": LAYOUT}]}
+    grouped, notes = helpers.run_layout_chain(prompt, max_retries=2, generation_mode="text", parse_mode="local")
+    assert grouped == []
+    assert notes == ["Could not read the response. Retrying 1/2...", "Could not read the response. Retrying 2/2...",
+                     "Max retries exhausted. Moving on to the next layout."]